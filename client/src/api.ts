@@ -87,6 +87,11 @@ type NewPollMessage = {
   options: Array<[text: string, id: number]>;
 };
 
+type NewPollsMessage = {
+  msg: "new_polls";
+  polls: Array<Omit<NewPollMessage, "msg">>;
+};
+
 type DeletePollMessage = {
   msg: "delete_poll";
   poll_id?: number;
@@ -109,6 +114,12 @@ type PollVoteMessage = {
   count: number;
 };
 
+type CountsMessage = {
+  msg: "counts";
+  polls: Array<[poll: number, option: number, count: number]>;
+  qas: Array<[qa: number, count: number]>;
+};
+
 type AuthMessage = {
   msg: "auth";
   bearer: string;
@@ -122,8 +133,10 @@ const authMessage = (token: string): AuthMessage => ({
 type Message =
   | AuthMessage
   | NewPollMessage
+  | NewPollsMessage
   | DeletePollMessage
   | PollVoteMessage
+  | CountsMessage
   | HidePollMessage
   | ShowPollMessage
   | NewDiscussionMessage
@@ -131,6 +144,9 @@ type Message =
   | DiscussionCommentMessage
   | DeleteDiscussionMessage;
 
+// The room to join, from the "room" query parameter of the page.
+const ROOM = new URLSearchParams(window.location.search).get("room") ?? "default";
+
 let socket: WebSocket | null = null;
 export const getSocket = (): WebSocket => {
   if (!socket) {
@@ -206,7 +222,7 @@ export const api = createApi({
       query: () => "/auth/me",
     }),
     state: builder.query<State, void>({
-      query: () => "/state/",
+      query: () => `/state/?room=${encodeURIComponent(ROOM)}`,
       async onCacheEntryAdded(
         _arg,
         { cacheDataLoaded, cacheEntryRemoved, updateCachedData }
@@ -252,6 +268,20 @@ export const api = createApi({
                 }
                 break;
 
+              case "new_polls":
+                {
+                  updateCachedData((state) => {
+                    state.polls = R.concat(
+                      R.reverse(
+                        message.polls.map((poll) => ({ ...poll, votes: {} }))
+                      ),
+                      state.polls
+                    );
+                    return state;
+                  });
+                }
+                break;
+
               case "delete_poll":
                 {
                   if (message.poll_id !== undefined) {
@@ -311,6 +341,26 @@ export const api = createApi({
                 }
                 break;
 
+              case "counts":
+                {
+                  updateCachedData((draft) => {
+                    for (const [id, option, count] of message.polls) {
+                      const poll = draft.polls.find((poll) => poll.id === id);
+                      if (poll !== undefined) {
+                        poll.votes[option] = count;
+                      }
+                    }
+                    for (const [id, count] of message.qas) {
+                      const qa = draft.qas.find((qa) => qa.id === id);
+                      if (qa !== undefined) {
+                        qa.votes = count;
+                      }
+                    }
+                    return draft;
+                  });
+                }
+                break;
+
               case "new_qa":
                 {
                   updateCachedData((state) => {
@@ -376,7 +426,7 @@ export const api = createApi({
           });
 
           socket.addEventListener("open", () => {
-            socket.send(JSON.stringify({ msg: "ready" }));
+            socket.send(JSON.stringify({ msg: "ready", room: ROOM }));
           });
 
           await cacheEntryRemoved;
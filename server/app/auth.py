@@ -1,6 +1,7 @@
 " User authentication with VIB Services "
 
 from datetime import datetime, timedelta, timezone
+from typing import Optional
 from urllib.parse import urlencode
 
 from fastapi import APIRouter, Depends, HTTPException, status
@@ -11,8 +12,10 @@ from sqlalchemy.orm import Session
 
 from app import crud, deps
 from app.config import settings
+from app.database import ReadSession, ready, run_blocking, run_reading
 from app.oidc import token, user_info
 from app.schemas import AuthorizationCode, Token, User
+from app.users import users
 
 router = APIRouter()
 
@@ -28,10 +31,16 @@ async def login_redirect(redirect: str) -> RedirectResponse:
         "state": "null",
     }
     return RedirectResponse(
-        f"https://services.vib.be/connect/authorize?{urlencode(params)}"
+        f"{settings.oidc_issuer}/connect/authorize?{urlencode(params)}"
     )
 
 
+def stored_role(subject: int) -> Optional[str]:
+    "The role of a user as stored, which `admin promote_user` may have changed."
+    with ReadSession() as database:
+        return crud.user_role(database, subject)
+
+
 def create_access_token(user: dict[str, str | int]) -> str:
     "Create an access token for this API."
     expire = datetime.now(timezone.utc) + timedelta(minutes=settings.api_token_expire)
@@ -64,13 +73,21 @@ async def get_bearer_token(
             status_code=status.HTTP_403_FORBIDDEN, detail=f"Decoding JWT: {err}"
         ) from err
 
-    if (
-        user := crud.get_user_by_subject(database, subject=int(id_token["sub"]))
-    ) is None:
+    await ready.wait()
+    # Returning users are known without provisioning them again, but their
+    # role is changed by the admin command, in another process: read it.
+    subject = int(id_token["sub"])
+    if (user := users.get(subject)) is not None:
+        if (role := await run_reading(stored_role, subject)) is None:
+            user = None
+        else:
+            user.role = role
+    if user is None:
         userinfo = await user_info(tkn["access_token"])
-        user = crud.create_user(
+        user = await run_blocking(
+            crud.provision_user,
             database,
-            subject=int(id_token["sub"]),
+            subject=subject,
             first_name=userinfo["name"],
             last_name=userinfo["family_name"],
             image=None,
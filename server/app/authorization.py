@@ -1,6 +1,9 @@
 " Application and API authorization functions "
 
+from collections import OrderedDict
 from datetime import datetime, timezone
+from hashlib import sha256
+from threading import Lock
 
 from jose import jwt
 from jose.exceptions import JOSEError
@@ -13,11 +16,10 @@ class AuthorizationError(Exception):
     "An error arrising from authorizing a user from a bearer token."
 
 
-def user_from_token(token: str) -> User:
+def verify(token: str) -> tuple[datetime, User]:
     """
-    Check user authorization from a bearer token.
-    Return user information on success.
-    Throw an error if authorization fails.
+    Decode and verify a bearer token.
+    Return its expiry and user information, or throw an error.
     """
     try:
         payload = jwt.decode(token, settings.api_secret, "HS256")
@@ -25,8 +27,68 @@ def user_from_token(token: str) -> User:
         raise AuthorizationError(str(err)) from err
 
     expiry = datetime.fromtimestamp(payload["exp"], tz=timezone.utc)
+    return (expiry, User(**payload))
+
+
+class TokenCache:
+    """
+    Remembers verified bearer tokens, so that a token seen before is not
+    decoded and verified again until it expires.
+    Holds at most `settings.token_cache_size` tokens, forgetting the least
+    recently used first. Tokens are keyed by their digest, not stored as is.
+    """
+
+    lock: Lock
+    tokens: OrderedDict[bytes, tuple[datetime, User]]
+    hits: int
+    misses: int
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.tokens = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> tuple[datetime, User]:
+        "The expiry and user information of a token, verifying it if it is not cached."
+        key = sha256(token.encode()).digest()
+        with self.lock:
+            if (cached := self.tokens.get(key)) is not None:
+                self.tokens.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        (expiry, user) = verify(token)
+        with self.lock:
+            self.tokens[key] = (expiry, user)
+            while len(self.tokens) > settings.token_cache_size:
+                self.tokens.popitem(last=False)
+        return (expiry, user)
+
+    def statistics(self) -> dict[str, float]:
+        "Cache hits, misses and size, for monitoring."
+        with self.lock:
+            return {
+                "token_cache_hits": self.hits,
+                "token_cache_misses": self.misses,
+                "token_cache_size": len(self.tokens),
+            }
+
+
+tokens = TokenCache()
+
+
+def user_from_token(token: str) -> User:
+    """
+    Check user authorization from a bearer token.
+    Return user information on success.
+    Throw an error if authorization fails.
+    """
+    (expiry, user) = tokens.get(token)
+
     current_time = datetime.now(tz=timezone.utc)
     if expiry < current_time:
         raise AuthorizationError("Credential has expired")
 
-    return User(**payload)
+    return user
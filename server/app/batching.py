@@ -0,0 +1,188 @@
+" Grouping bursts of votes into a single database transaction "
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, NamedTuple, Optional, Union
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import crud
+from app.client import Message, response
+from app.config import settings
+from app.database import Session, run_blocking
+from app.tally import tally
+
+log = logging.getLogger(__name__)
+
+
+class PollToggle(NamedTuple):
+    "A users vote on a poll option, to be added or removed."
+    user: int
+    poll: int
+    option: int
+    room: str
+
+
+class QuestionToggle(NamedTuple):
+    "A users vote on a question, to be added or removed."
+    user: int
+    question: int
+    room: str
+
+
+Toggle = Union[PollToggle, QuestionToggle]
+
+
+class NotFound(LookupError):
+    "The room of a vote toggle has no such poll option or question."
+
+
+def apply(toggles: list[Toggle]) -> tuple[list[tuple[str, Message]], set[Toggle]]:
+    """
+    Write a batch of vote toggles in one transaction, update the tally,
+    and return one count update message (and the room to send it to)
+    per poll option or question that changed, and the toggles that were
+    not written because their room has no such poll option or question.
+    """
+    polls = [toggle for toggle in toggles if isinstance(toggle, PollToggle)]
+    questions = [toggle for toggle in toggles if isinstance(toggle, QuestionToggle)]
+    missing: set[Toggle] = set()
+
+    with Session() as database:
+        poll_added = crud.toggle_poll_votes(
+            database, [(t.user, t.poll, t.option, t.room) for t in polls], commit=False
+        )
+        question_added = crud.toggle_qa_votes(
+            database, [(t.user, t.question, t.room) for t in questions], commit=False
+        )
+        try:
+            database.commit()
+        except SQLAlchemyError as err:
+            database.rollback()
+            raise err
+
+        options = {}
+        for toggle, added in zip(polls, poll_added):
+            if added is None:
+                missing.add(toggle)
+                continue
+            tally.poll_vote(toggle.poll, toggle.option, added)
+            options[(toggle.poll, toggle.option)] = toggle.room
+        changed = {}
+        for qtoggle, added in zip(questions, question_added):
+            if added is None:
+                missing.add(qtoggle)
+                continue
+            tally.qa_vote(qtoggle.question, added)
+            changed[qtoggle.question] = qtoggle.room
+        if settings.broadcast_bus != "local":
+            # Other server processes record votes too, only the database knows all.
+            tally.recount(database, set(options), set(changed))
+
+    return [
+        (
+            room,
+            response(
+                "poll_vote",
+                {
+                    "poll": poll,
+                    "option": option,
+                    "count": tally.poll_votes(poll, option),
+                },
+            ),
+        )
+        for ((poll, option), room) in options.items()
+    ] + [
+        (room, response("qa_vote", {"qa": question, "count": tally.qa_votes(question)}))
+        for (question, room) in changed.items()
+    ], missing
+
+
+class VoteBatcher:
+    """
+    Collects vote toggles for a short window (or until enough have arrived)
+    and writes them together, so a burst of votes costs one transaction and
+    one broadcast per changed count instead of one of each per vote.
+    """
+
+    publish: Callable[[list[tuple[str, Message]]], Awaitable[None]]
+    invalidate: Callable[[str], None]
+    pending: list[tuple[Toggle, "asyncio.Future[None]"]]
+    timer: Optional[asyncio.TimerHandle]
+    flushes: set["asyncio.Task[None]"]
+
+    def __init__(
+        self,
+        publish: Callable[[list[tuple[str, Message]]], Awaitable[None]],
+        invalidate: Callable[[str], None],
+    ):
+        self.publish = publish
+        self.invalidate = invalidate
+        self.pending = []
+        self.timer = None
+        self.flushes = set()
+
+    async def toggle(self, toggle: Toggle) -> None:
+        """
+        Queue a vote toggle and wait until it has been written.
+        Raises NotFound if the room has no such poll option or question,
+        or whatever writing the batch failed with.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((toggle, future))
+
+        if len(self.pending) >= settings.vote_batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                settings.vote_batch_window, self.flush
+            )
+
+        await future
+
+    def flush(self) -> None:
+        "Start writing all pending toggles."
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.pending:
+            return
+
+        (batch, self.pending) = (self.pending, [])
+        task = asyncio.create_task(self.write(batch))
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    async def write(self, batch: list[tuple[Toggle, "asyncio.Future[None]"]]) -> None:
+        "Write a batch of toggles, wake up the voters and publish the new counts."
+        log.debug("Writing %d vote toggles", len(batch))
+        try:
+            (messages, missing) = await run_blocking(
+                apply, [toggle for (toggle, _) in batch]
+            )
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            log.error("Writing votes failed: %s", err)
+            # The rolled back votes may have been read meanwhile.
+            for room in {toggle.room for (toggle, _) in batch}:
+                self.invalidate(room)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        # The votes are stored: wake up the voters whatever happens to the broadcast.
+        for toggle, future in batch:
+            if future.done():
+                continue
+            if toggle in missing:
+                future.set_exception(NotFound("not found"))
+            else:
+                future.set_result(None)
+
+        try:
+            await self.publish(messages)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            log.error("Publishing vote counts failed: %s", err)
+            for room in {room for (room, _) in messages}:
+                self.invalidate(room)
@@ -0,0 +1,271 @@
+" Delivering broadcasts to the clients of every server process "
+# pylint: disable=too-few-public-methods
+
+import argparse
+import asyncio
+from contextlib import suppress
+import logging
+from typing import Awaitable, Callable, Optional, Protocol, Union
+from urllib.parse import urlparse
+from uuid import uuid4 as uuid
+
+log = logging.getLogger(__name__)
+
+Receiver = Callable[[str], Awaitable[None]]
+
+
+class Bus(Protocol):
+    "Publish/subscribe transport between the processes serving websockets."
+
+    async def start(self, receive: Receiver) -> None:
+        "Connect, and pass every payload published by _other_ processes to `receive`."
+
+    async def publish(self, payload: str) -> None:
+        "Send a payload to all other processes."
+
+    async def stop(self) -> None:
+        "Disconnect."
+
+
+class LocalBus:
+    "A bus for a single process: there is nobody else to deliver to."
+
+    async def start(self, receive: Receiver) -> None:
+        "Nothing to connect to."
+
+    async def publish(self, payload: str) -> None:
+        "Nothing to deliver."
+
+    async def stop(self) -> None:
+        "Nothing to disconnect."
+
+
+# A small subset of the Redis serialization protocol (RESP)
+
+Reply = Union[None, int, bytes, list["Reply"]]
+
+
+def bulk(value: Union[str, bytes]) -> bytes:
+    "Encode a RESP bulk string."
+    data = value.encode() if isinstance(value, str) else value
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+def command(*args: Union[str, bytes]) -> bytes:
+    "Encode a command as a RESP array of bulk strings."
+    return b"*%d\r\n" % len(args) + b"".join(bulk(arg) for arg in args)
+
+
+async def read_reply(reader: asyncio.StreamReader) -> Reply:
+    "Read one RESP value."
+    line = (await reader.readuntil(b"\r\n"))[:-2]
+    kind, rest = line[:1], line[1:]
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        raise ConnectionError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        if (length := int(rest)) < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        return [await read_reply(reader) for _ in range(int(rest))]
+    raise ConnectionError(f"Unexpected reply: {line!r}")
+
+
+# Seconds to wait before reconnecting to a lost bus, doubled after every
+# failed attempt up to the maximum.
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+Connection = tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class RedisBus:
+    """
+    A bus over a Redis pub/sub channel (or anything speaking the same protocol,
+    such as the stand-in started with `poetry run bus`).
+    Payloads are tagged with the origin process, so a process ignores its own.
+    A lost connection is reopened, broadcasts published meanwhile are lost.
+    """
+
+    host: str
+    port: int
+    channel: str
+    origin: str
+    publisher: Optional[asyncio.StreamWriter]
+    tasks: list["asyncio.Task[None]"]
+
+    def __init__(self, uri: str, channel: str):
+        parsed = urlparse(uri)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.channel = channel
+        self.origin = uuid().hex
+        self.publisher = None
+        self.tasks = []
+
+    async def start(self, receive: Receiver) -> None:
+        "Connect, and keep reconnecting whenever the connection is lost."
+        connections = await self.connect()
+        self.tasks = [asyncio.create_task(self.run(connections, receive))]
+
+    async def connect(self) -> tuple[Connection, Connection]:
+        "Open a connection for publishing and another one subscribed to the channel."
+        publisher = await asyncio.open_connection(self.host, self.port)
+        subscriber = await asyncio.open_connection(self.host, self.port)
+        subscriber[1].write(command("SUBSCRIBE", self.channel))
+        await subscriber[1].drain()
+        log.info("Subscribed to %s on %s:%d", self.channel, self.host, self.port)
+
+        self.publisher = publisher[1]
+        return (publisher, subscriber)
+
+    async def run(
+        self, connections: tuple[Connection, Connection], receive: Receiver
+    ) -> None:
+        "Use the connections until either is lost, then reconnect with a backoff."
+        while True:
+            ((replies, publisher), (reader, subscriber)) = connections
+            tasks = {
+                asyncio.create_task(self.discard(replies)),
+                asyncio.create_task(self.listen(reader, receive)),
+            }
+            try:
+                (done, _) = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    log.error("Lost the broadcast bus: %s", task.exception())
+            finally:
+                for task in tasks:
+                    task.cancel()
+                self.publisher = None
+                publisher.close()
+                subscriber.close()
+
+            connections = await self.reconnect()
+
+    async def reconnect(self) -> tuple[Connection, Connection]:
+        "Try to connect again, waiting longer after every failure."
+        delay = RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                return await self.connect()
+            except OSError as err:
+                log.error("Reconnecting to the broadcast bus: %s", err)
+                delay = min(2 * delay, RECONNECT_MAX_DELAY)
+
+    async def discard(self, reader: asyncio.StreamReader) -> None:
+        "Read and ignore the replies to PUBLISH, so they do not pile up."
+        while True:
+            await read_reply(reader)
+
+    async def listen(self, reader: asyncio.StreamReader, receive: Receiver) -> None:
+        "Pass payloads published by other processes on to `receive`."
+        while True:
+            reply = await read_reply(reader)
+            if not (isinstance(reply, list) and reply[0] == b"message"):
+                continue
+            if not isinstance(payload := reply[2], bytes):
+                continue
+            (origin, _, message) = payload.decode().partition(" ")
+            if origin != self.origin:
+                await receive(message)
+
+    async def publish(self, payload: str) -> None:
+        "Publish a payload, tagged with this process, on the channel."
+        if self.publisher is None:
+            return
+        try:
+            self.publisher.write(
+                command("PUBLISH", self.channel, f"{self.origin} {payload}")
+            )
+            await self.publisher.drain()
+        except ConnectionError as err:
+            log.error("Publishing to the broadcast bus: %s", err)
+
+    async def stop(self) -> None:
+        "Stop reconnecting and close both connections."
+        for task in self.tasks:
+            task.cancel()
+        for task in self.tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+        self.tasks = []
+
+
+def connect(uri: str, channel: str) -> Bus:
+    "Choose a bus: `local` or `redis://host:port`."
+    if uri.startswith("redis://"):
+        return RedisBus(uri, channel)
+    return LocalBus()
+
+
+# A stand-in for a Redis server, supporting just enough for the RedisBus
+
+
+class StandIn:
+    "Forwards PUBLISHed messages to SUBSCRIBEd connections."
+
+    subscribers: dict[bytes, set[asyncio.StreamWriter]]
+
+    def __init__(self) -> None:
+        self.subscribers = {}
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        "Serve a single connection."
+        try:
+            while True:
+                request = await read_reply(reader)
+                if not isinstance(request, list) or not request:
+                    break
+                [name, *args] = [arg for arg in request if isinstance(arg, bytes)]
+                match name.upper(), args:
+                    case b"PING", _:
+                        writer.write(b"+PONG\r\n")
+                    case b"SUBSCRIBE", channels:
+                        for count, channel in enumerate(channels, start=1):
+                            self.subscribers.setdefault(channel, set()).add(writer)
+                            writer.write(
+                                b"*3\r\n"
+                                + bulk("subscribe")
+                                + bulk(channel)
+                                + b":%d\r\n" % count
+                            )
+                    case b"PUBLISH", [channel, message]:
+                        receivers = self.subscribers.get(channel, set())
+                        for receiver in receivers:
+                            receiver.write(command("message", channel, message))
+                        writer.write(b":%d\r\n" % len(receivers))
+                    case _:
+                        writer.write(b"-ERR unsupported command\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for subscribers in self.subscribers.values():
+                subscribers.discard(writer)
+            writer.close()
+
+
+def serve() -> None:
+    "Run a stand-in broadcast bus for local multi-worker testing."
+    parser = argparse.ArgumentParser(description="Stand-in broadcast bus")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+
+    async def run() -> None:
+        server = await asyncio.start_server(StandIn().handle, args.host, args.port)
+        log.info("Stand-in broadcast bus on %s:%d", args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run())
@@ -1,13 +1,23 @@
 " Handling of connected realtime clients "
 
+import asyncio
+from collections import deque
+from collections.abc import Hashable
+from contextlib import suppress
+import json
 import logging
-from typing import Any, Literal
+import re
+from typing import Any, Callable, Literal, NamedTuple, Optional
 from uuid import UUID, uuid4 as uuid
 
-from fastapi import WebSocket
+from fastapi import WebSocket, status
 
+from app import metrics
 from app.authorization import user_from_token
-from app.schemas import User
+from app.bus import Bus
+from app.config import settings
+from app.models import DEFAULT_ROOM
+from app.schemas import ROOM_PATTERN, User
 
 # A Message is a Package with a "msg" field
 Message = dict[str, str | int | list[Any]]
@@ -16,16 +26,122 @@ Package = dict[str, str | int | list[Any]]
 log = logging.getLogger(__name__)
 
 
-class Client:
+class Frame(NamedTuple):
+    "A message serialized once, ready to be sent to any number of clients."
+    text: str
+    size: int  # in bytes, as sent on the wire
+
+
+try:
+    import orjson
+
+    def encode(message: Message) -> Frame:
+        "Serialize a message into a websocket text frame."
+        data = orjson.dumps(message)  # pylint: disable=no-member
+        metrics.increment("broadcast_bytes_encoded", len(data))
+        return Frame(data.decode(), len(data))
+
+except ImportError:
+
+    def encode(message: Message) -> Frame:
+        "Serialize a message into a websocket text frame."
+        # ASCII only output, so the length of the text is the length in bytes
+        text = json.dumps(message, separators=(",", ":"))
+        metrics.increment("broadcast_bytes_encoded", len(text))
+        return Frame(text, len(text))
+
+
+def coalesce_key(message: Message) -> Optional[Hashable]:
+    """
+    Identify messages that carry an absolute value, so that a newer message
+    with the same key supersedes an older one that has not been sent yet.
+    Return None for messages which must never be merged.
+    """
+    match message.get("msg"):
+        case "poll_vote":
+            return ("poll_vote", message.get("poll"), message.get("option"))
+        case "qa_vote":
+            return ("qa_vote", message.get("qa"))
+        case _:
+            return None
+
+
+class Outbox:
+    "A bounded queue of messages waiting to be sent to a single client."
+    maxsize: int
+    pending: deque[tuple[Optional[Hashable], Frame]]
+    nonempty: asyncio.Event
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.pending = deque()
+        self.nonempty = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def full(self) -> bool:
+        "Is there no more room in the outbox?"
+        return len(self.pending) >= self.maxsize
+
+    def put(self, key: Optional[Hashable], frame: Frame) -> None:
+        "Add a frame to the back of the outbox."
+        self.pending.append((key, frame))
+        self.nonempty.set()
+
+    def coalesce(self, key: Optional[Hashable], frame: Frame) -> bool:
+        """
+        Add a frame to a full outbox, by replacing the pending frames with the
+        same coalescing key: the newest one takes the place of the last of
+        them, the others are dropped. Returns False, leaving the outbox as it
+        was, if there is no such frame: no other frame may be lost.
+        """
+        if key is None:
+            return False
+        matches = [i for (i, (pending, _)) in enumerate(self.pending) if pending == key]
+        if not matches:
+            return False
+        self.pending[matches[-1]] = (key, frame)
+        for i in reversed(matches[:-1]):
+            del self.pending[i]
+        return True
+
+    async def get(self) -> Frame:
+        "Wait for and remove the oldest pending frame."
+        while not self.pending:
+            self.nonempty.clear()
+            await self.nonempty.wait()
+        return self.pending.popleft()[1]
+
+
+class Client:  # pylint: disable=too-many-instance-attributes
     "A connected client: tracks useful data for a connected client."
+    __slots__ = ("uid", "socket", "user", "room", "outbox", "writer", "dead", "failed")
+
     uid: UUID
     socket: WebSocket
     user: User
+    room: str
+    outbox: Outbox
+    writer: Optional["asyncio.Task[None]"]
+    dead: bool
+    failed: Callable[["Client"], None]
 
-    def __init__(self, socket: WebSocket, user: User):
+    def __init__(
+        self,
+        socket: WebSocket,
+        user: User,
+        room: str,
+        failed: Callable[["Client"], None],
+    ):
         self.uid = uuid()
         self.socket = socket
         self.user = user
+        self.room = room
+        self.outbox = Outbox(settings.broadcast_queue_size)
+        self.writer = None
+        self.dead = False
+        self.failed = failed
 
     @property
     def name(self) -> str:
@@ -37,6 +153,118 @@ class Client:
         "Derive connected users role."
         return self.user.role
 
+    def start(self) -> None:
+        "Start the task that drains this clients outbox into its websocket."
+        self.writer = asyncio.create_task(self.write(), name=f"writer-{self.uid}")
+
+    def stop(self) -> None:
+        "Stop sending messages to this client. Pending messages are discarded."
+        if self.writer is not None:
+            self.writer.cancel()
+            self.writer = None
+
+    def send(self, message: Message) -> None:
+        "Queue a message for this client only."
+        self.deliver(coalesce_key(message), encode(message))
+
+    def deliver(self, key: Optional[Hashable], frame: Frame) -> None:
+        """
+        Queue an encoded message for this client without waiting for it to be sent.
+        When the outbox is full the `broadcast_overflow` setting decides whether
+        the frame is dropped, replaces a pending frame with the same absolute
+        count, or the client is disconnected. Clients that cannot be caught up
+        by coalescing are disconnected too, so that they reconnect and fetch
+        the current state.
+        """
+        if self.dead:
+            return
+
+        if not self.outbox.full():
+            self.outbox.put(key, frame)
+        elif settings.broadcast_overflow == "drop":
+            log.warning("Outbox full for %s: dropping frame", self.uid)
+        elif settings.broadcast_overflow == "coalesce" and self.outbox.coalesce(
+            key, frame
+        ):
+            return
+        else:
+            log.warning("Outbox full for %s: disconnecting", self.uid)
+            metrics.increment("clients_slow")
+            self.fail()
+
+    def fail(self) -> None:
+        "Stop sending to this client and have it evicted."
+        if not self.dead:
+            self.dead = True
+            self.failed(self)
+
+    async def write(self) -> None:
+        """
+        Send queued messages to the websocket, one at a time, in order.
+        A send that fails or takes longer than `settings.send_timeout` gets
+        the client evicted: a dead peer never holds up anybody else.
+        """
+        try:
+            while True:
+                frame = await self.outbox.get()
+                await asyncio.wait_for(
+                    self.socket.send_text(frame.text), settings.send_timeout
+                )
+                metrics.increment("broadcast_bytes_sent", frame.size)
+        except asyncio.TimeoutError:
+            log.warning("Sending to %s timed out", self.uid)
+            metrics.increment("clients_slow")
+            self.fail()
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            log.warning("Sending to %s failed: %s", self.uid, err)
+            self.fail()
+
+    async def close(self) -> None:
+        "Close the websocket of an evicted client, if it is still open."
+        with suppress(Exception):
+            await asyncio.wait_for(
+                self.socket.close(code=status.WS_1013_TRY_AGAIN_LATER),
+                settings.send_timeout,
+            )
+
+
+class Registry:
+    """
+    The connected clients, keyed by uid and indexed by room, so that adding,
+    removing and looking up clients does not depend on how many clients are
+    connected.
+    Lookups return snapshots: clients may come and go while a caller iterates.
+    """
+
+    clients: dict[UUID, Client]
+    rooms: dict[str, dict[UUID, Client]]
+
+    def __init__(self) -> None:
+        self.clients = {}
+        self.rooms = {}
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def add(self, client: Client) -> None:
+        "Register a connected client."
+        self.clients[client.uid] = client
+        self.rooms.setdefault(client.room, {})[client.uid] = client
+
+    def remove(self, client: Client) -> bool:
+        "Forget a client. Return whether it was registered."
+        if self.clients.pop(client.uid, None) is None:
+            return False
+        room = self.rooms[client.room]
+        del room[client.uid]
+        if not room:
+            del self.rooms[client.room]
+        return True
+
+    def in_room(self, room: str) -> tuple[Client, ...]:
+        "All clients in a room."
+        return tuple(self.rooms.get(room, {}).values())
+
 
 def connected(client: Client) -> Message:
     "Construct a message to connected clients that another client has connected."
@@ -47,9 +275,9 @@ def connected(client: Client) -> Message:
     }
 
 
-def disconnected(client: Client) -> Message:
-    "Construct a message to connected clients that a client has disconnected."
-    return {"msg": "disconnected", "id": str(client.uid)}
+def disconnected(clients: list[Client]) -> Message:
+    "Construct a message to connected clients that one or more clients have disconnected."
+    return {"msg": "disconnected", "ids": [str(client.uid) for client in clients]}
 
 
 def error(message: str) -> Message:
@@ -68,9 +296,30 @@ def response(message: str, package: Package) -> Message:
 class ConnectionManager:
     """
     Tracks all connected clients and provides operations for communicating with connected clients.
+    Clients are grouped by the room they joined, broadcasts only reach one room.
+    Broadcasts also go out over a bus, to reach the clients of other server processes.
     """
 
-    clients: list[Client] = []
+    registry: Registry
+    bus: Bus
+    on_remote: Callable[[str, Message], None]
+    dead: list[Client]
+    evicting: Optional["asyncio.Task[None]"]
+
+    def __init__(self, bus: Bus, on_remote: Callable[[str, Message], None]):
+        self.registry = Registry()
+        self.bus = bus
+        self.on_remote = on_remote
+        self.dead = []
+        self.evicting = None
+
+    async def start(self) -> None:
+        "Start receiving broadcasts from other server processes."
+        await self.bus.start(self.receive)
+
+    async def stop(self) -> None:
+        "Stop receiving broadcasts from other server processes."
+        await self.bus.stop()
 
     async def connect(self, socket: WebSocket) -> Client:
         """
@@ -78,45 +327,104 @@ class ConnectionManager:
         Perform startup handshake when a client connects to a WebSocket.
         Return a connected client object or throw an exception.
         """
-        # Wait for a "ready" message
+        # Wait for a "ready" message, optionally naming the room to join
         log.info("Waiting on 'ready' message")
         ready = await socket.receive_json()
         log.info("Ready: %s", ready)
+        room = ready.get("room", DEFAULT_ROOM)
+        if not isinstance(room, str) or re.match(ROOM_PATTERN, room) is None:
+            raise ValueError(f"Invalid room: {room}")
         # Request the bearer token.
         log.info("Requesting bearer token")
         await socket.send_json({"msg": "auth"})
         token = await socket.receive_json()
         user = user_from_token(token["bearer"])
 
-        client = Client(socket, user)
-        await self.broadcast(connected(client))
+        client = Client(socket, user, room, self.evict)
+        await self.broadcast(room, connected(client))
 
-        self.clients.append(client)
-        log.info("Client %s added: %s (%s)", client.uid, client.name, client.role)
+        client.start()
+        self.registry.add(client)
+        log.info(
+            "Client %s added to %s: %s (%s)",
+            client.uid,
+            room,
+            client.name,
+            client.role,
+        )
 
         return client
 
-    async def broadcast(self, message: Message) -> None:
+    async def broadcast(self, room: str, message: Message) -> None:
         """
-        Send a message to _all_ connected clients.
-        This can throw a `WebSocketDisconnect exception when a client
-        has closed the connection already.
+        Send a message to _all_ clients connected to a room.
+        The message is serialized once and the resulting frame is queued for
+        each client, to be sent by that clients writer task, so a slow client
+        does not hold up everybody else.
         """
-        log.info("broadcast()ing: %s", message)
+        log.info("broadcast()ing to %s: %s", room, message)
+
+        frame = encode(message)
+        self.deliver(room, coalesce_key(message), frame)
+        await self.bus.publish(f"{room}\n{frame.text}")
+
+        log.info("Broadcast queued")
 
-        for client in self.clients:
-            log.debug("Sending to %s", client.uid)
-            await client.socket.send_json(message)
+    async def receive(self, payload: str) -> None:
+        "Deliver a broadcast from another server process to the clients of this one."
+        (room, _, text) = payload.partition("\n")
+        message = json.loads(text)
+        log.info("Received broadcast to %s: %s", room, message)
 
-        log.info("Broadcast sent")
+        self.deliver(room, coalesce_key(message), Frame(text, len(text.encode())))
+        self.on_remote(room, message)
+
+    def deliver(self, room: str, key: Optional[Hashable], frame: Frame) -> None:
+        "Queue an encoded message for the clients of a room connected to this process."
+        for client in self.registry.in_room(room):
+            log.debug("Queueing for %s", client.uid)
+            client.deliver(key, frame)
 
     async def disconnect(self, client: Client) -> None:
         """
         Remove a client from the list of connected clients.
+        Disconnecting a client that was already evicted does nothing.
         NOTE: This function does _not_ close the websocket connection.
         """
         log.info("disconnect(%s) %s", client.uid, client.name)
-        self.clients.remove(client)
+        client.stop()
+        if not self.registry.remove(client):
+            return
         log.info("Client %s removed", client.uid)
 
-        await self.broadcast(disconnected(client))
+        await self.broadcast(client.room, disconnected([client]))
+
+    def evict(self, client: Client) -> None:
+        """
+        Schedule the removal of a client that failed or fell behind.
+        Clients failing within `settings.eviction_window` of each other,
+        typically during the same broadcast, are evicted together.
+        """
+        self.dead.append(client)
+        if self.evicting is None:
+            self.evicting = asyncio.create_task(self.evict_dead(), name="eviction")
+
+    async def evict_dead(self) -> None:
+        "Remove, announce and close all clients scheduled for eviction."
+        await asyncio.sleep(settings.eviction_window)
+        (dead, self.dead) = (self.dead, [])
+        self.evicting = None
+
+        rooms: dict[str, list[Client]] = {}
+        for client in dead:
+            client.stop()
+            if self.registry.remove(client):
+                rooms.setdefault(client.room, []).append(client)
+        evicted = sum(len(clients) for clients in rooms.values())
+        log.warning("Evicted %d clients", evicted)
+        metrics.increment("clients_evicted", evicted)
+
+        for room, clients in rooms.items():
+            await self.broadcast(room, disconnected(clients))
+        # Closing makes the receiving side raise WebSocketDisconnect.
+        await asyncio.gather(*(client.close() for client in dead))
@@ -2,6 +2,7 @@
 # pylint: disable=too-few-public-methods
 
 import secrets
+from typing import Literal
 
 from pydantic import BaseSettings
 
@@ -9,12 +10,71 @@ from pydantic import BaseSettings
 class Settings(BaseSettings):
     "Application runtime configuration."
     client_secret: str = "????"
+    # The OpenID Connect provider, and the HTTP connections kept open to it.
+    # Its signing keys are cached for as long as its Cache-Control header
+    # allows, or `oidc_jwks_max_age` seconds if it does not say.
+    oidc_issuer: str = "https://services.vib.be"
+    oidc_connections: int = 20
+    oidc_timeout: float = 10.0
+    oidc_jwks_max_age: float = 300.0
 
     api_secret: str = secrets.token_urlsafe(32)
     api_token_expire: int = 12 * 60  # 12 hours in minutes
+    # Verified bearer tokens remembered until they expire, to skip verifying them again.
+    token_cache_size: int = 4096
 
     backup_database_uri: str = "sqlite:///buzz.sqlite"
     database_uri: str = "sqlite:///:memory:"
+    # An in-memory database is copied to the backup database every
+    # `backup_interval` seconds (0 to only save on shutdown), which bounds how
+    # much is lost on a crash. Copies are made `backup_pages` pages at a time.
+    backup_interval: float = 30.0
+    backup_pages: int = 256
+    backup_sleep: float = 0.005
+    # Serve GET /state/ from the backup database while it is being restored.
+    serve_during_restore: bool = False
+    # Threads running blocking database work. All writes share a single
+    # SQLite connection, so more than one thread only helps file databases.
+    database_threads: int = 1
+    # Read-only connections, each with a thread of its own, serving /state/ and
+    # exports without waiting for the writes. They share an in-memory database
+    # through SQLite's shared cache, and a file database through its WAL.
+    database_readers: int = 4
+    # SQLite engine profile, applied to every new connection of every engine.
+    # The journal mode only matters to file databases: in-memory ones always
+    # keep their journal in memory. Negative cache sizes are in KiB, positive
+    # ones in pages. Up to `sqlite_cached_statements` prepared statements are
+    # kept per connection.
+    sqlite_journal_mode: Literal["DELETE", "TRUNCATE", "PERSIST", "WAL"] = "WAL"
+    sqlite_synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_cache_size: int = -64 * 1024
+    sqlite_temp_store: Literal["DEFAULT", "FILE", "MEMORY"] = "MEMORY"
+    sqlite_cached_statements: int = 256
+
+    # Realtime: messages waiting to be sent to a single client, and what to do
+    # when a client falls so far behind that its queue is full. "coalesce" only
+    # replaces a queued vote count with a newer one, and otherwise disconnects.
+    broadcast_queue_size: int = 256
+    broadcast_overflow: Literal["drop", "coalesce", "disconnect"] = "coalesce"
+    # Clients whose connection fails, or that take longer than this many seconds
+    # to accept a single message, are evicted. Evictions within a short window
+    # are announced together in one "disconnected" message per room.
+    send_timeout: float = 10.0
+    eviction_window: float = 0.05
+    # "local" for a single server process, or "redis://host:port" to share
+    # broadcasts between processes (which then also need a shared database_uri).
+    broadcast_bus: str = "local"
+    broadcast_bus_channel: str = "buzz"
+
+    # Votes arriving within this many seconds of each other, up to a maximum
+    # number, are written in one transaction and announced once per count.
+    vote_batching: bool = True
+    vote_batch_window: float = 0.02
+    vote_batch_size: int = 200
+    # When above zero, count updates from batched votes are not broadcast one
+    # by one, but collected and sent as one "counts" message this often per second.
+    counts_tick_rate: float = 0
 
 
 settings = Settings()
@@ -0,0 +1,86 @@
+" Rate limited announcements of changed vote counts "
+
+import asyncio
+from collections import defaultdict
+import logging
+from typing import Awaitable, Callable, Optional
+
+from app.client import Message
+from app.config import settings
+
+log = logging.getLogger(__name__)
+
+
+class CountsTicker:
+    """
+    Accumulates vote count updates and announces them at a fixed rate
+    (`settings.counts_tick_rate` per second) in a single "counts" message.
+    Each message only contains the counts that changed since the previous one,
+    so traffic grows with the tick rate rather than with the number of votes.
+    Counts are kept per room, every room gets its own "counts" message.
+    """
+
+    broadcast: Callable[[str, Message], Awaitable[None]]
+    options: defaultdict[str, dict[tuple[int, int], int]]
+    questions: defaultdict[str, dict[int, int]]
+    task: Optional["asyncio.Task[None]"]
+
+    def __init__(self, broadcast: Callable[[str, Message], Awaitable[None]]):
+        self.broadcast = broadcast
+        self.options = defaultdict(dict)
+        self.questions = defaultdict(dict)
+        self.task = None
+
+    def update(self, room: str, messages: list[Message]) -> None:
+        "Record the latest counts in a room from poll_vote and qa_vote messages."
+        for message in messages:
+            count = message.get("count")
+            if not isinstance(count, int):
+                continue
+
+            if message["msg"] == "poll_vote":
+                poll = message.get("poll")
+                option = message.get("option")
+                if isinstance(poll, int) and isinstance(option, int):
+                    self.options[room][(poll, option)] = count
+            elif message["msg"] == "qa_vote":
+                question = message.get("qa")
+                if isinstance(question, int):
+                    self.questions[room][question] = count
+
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(), name="counts-ticker")
+
+    def stop(self) -> None:
+        "Stop announcing counts."
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self) -> None:
+        "Announce changed counts on every tick."
+        while True:
+            await asyncio.sleep(1 / settings.counts_tick_rate)
+            await self.flush()
+
+    async def flush(self) -> None:
+        "Announce the counts that changed since the last announcement, if any."
+        (rooms_options, self.options) = (self.options, defaultdict(dict))
+        (rooms_questions, self.questions) = (self.questions, defaultdict(dict))
+
+        for room in set(rooms_options) | set(rooms_questions):
+            options = rooms_options.get(room, {})
+            questions = rooms_questions.get(room, {})
+            await self.broadcast(
+                room,
+                {
+                    "msg": "counts",
+                    "polls": [
+                        [poll, option, count]
+                        for ((poll, option), count) in options.items()
+                    ],
+                    "qas": [
+                        [question, count] for (question, count) in questions.items()
+                    ],
+                },
+            )
@@ -1,14 +1,22 @@
 " Create, Read, Update, and Delete on database reseources "
+# pylint: disable=not-callable
 
-from typing import Optional
+from collections.abc import Collection, Iterator
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Optional, cast
 from datetime import datetime, timezone
 
-from sqlalchemy import desc
+from sqlalchemy import delete, desc, insert, select, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import CursorResult
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, aliased
 
 from app import schemas
+from app.users import users
 from app.models import (
+    DEFAULT_ROOM,
     User,
     Poll,
     PollOption,
@@ -21,11 +29,6 @@ from app.models import (
 # Auth
 
 
-def get_user_by_subject(database: Session, subject: int) -> Optional[User]:
-    "Retrieve a user from the database given their OpenID Connect unique identifier (subject)."
-    return database.query(User).filter(User.id == subject).one_or_none()
-
-
 def create_user(
     database: Session,
     subject: int,
@@ -55,8 +58,63 @@ def create_user(
     return user
 
 
+def user_role(database: Session, subject: int) -> Optional[str]:
+    "The stored role of a user, if the user exists."
+    return database.scalar(select(User.role).where(User.id == subject))
+
+
+def provision_user(
+    database: Session,
+    subject: int,
+    first_name: str,
+    last_name: str,
+    image: Optional[str],
+) -> User:
+    """
+    Create a user in the database, or update the name of an existing one,
+    in a single statement returning the stored user.
+    """
+    statement = sqlite_insert(User).values(  # type: ignore[no-untyped-call]
+        id=subject,
+        created=datetime.now(timezone.utc),
+        first_name=first_name,
+        last_name=last_name,
+        role="user",
+        image=image,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[User.id],
+        set_={
+            "first_name": statement.excluded.first_name,
+            "last_name": statement.excluded.last_name,
+        },
+    )
+
+    try:
+        user: User = database.scalars(
+            statement.returning(User),
+            execution_options={"populate_existing": True},
+        ).one()
+    except SQLAlchemyError as err:
+        database.rollback()
+        raise err
+
+    database.commit()
+    users.put(user)
+    return user
+
+
+def all_users(database: Session) -> list[User]:
+    "Retrieve all users from the database."
+    return list(database.scalars(select(User)))
+
+
 def promote(database: Session, uid: int) -> Optional[User]:
-    "Promote a user: change role from user to admin."
+    """
+    Promote a user: change role from user to admin.
+    The role is a claim of the bearer tokens, so only tokens issued after
+    the promotion carry it.
+    """
     if (user := database.query(User).filter(User.id == uid).one_or_none()) is not None:
         user.role = "admin"
         database.commit()
@@ -67,123 +125,442 @@ def promote(database: Session, uid: int) -> Optional[User]:
 # Polls
 
 
-def all_polls(database: Session) -> list[Poll]:
-    "Retrieve all polls from the database."
-    return database.query(Poll).order_by(desc(Poll.created)).all()
+def deck(
+    database: Session, room: str, chunk_size: int = 1000
+) -> Iterator[schemas.NewPoll]:
+    """
+    All polls of a room in the order they were created, read `chunk_size` rows
+    at a time rather than all at once.
+    """
+    rows = database.execute(
+        select(
+            Poll.id,
+            Poll.title,
+            Poll.description,
+            Poll.hidden,
+            PollOption.text,
+        )
+        .outerjoin(PollOption, PollOption.poll == Poll.id)
+        .where(Poll.room == room)
+        .order_by(Poll.id, PollOption.id)
+        .execution_options(yield_per=chunk_size)
+    ).tuples()
+
+    for _, group in groupby(rows, key=itemgetter(0)):
+        poll = list(group)
+        (_, title, description, hidden, _) = poll[0]
+        yield schemas.NewPoll(
+            title=title,
+            description=description or "",
+            hidden=hidden,
+            options=[text for (*_, text) in poll if text is not None],
+        )
+
+
+def poll_results(
+    database: Session,
+    room: str,
+    after: Optional[tuple[int, int]] = None,
+    limit: int = 1000,
+) -> list[tuple[int, str, int, str, int]]:
+    """
+    Retrieve (poll id, title, option id, option text, votes) for up to `limit`
+    options of the polls in a room, oldest first, following the option with
+    the (poll id, option id) `after`. Each chunk is a query of its own.
+    """
+    query = (
+        select(
+            Poll.id,
+            Poll.title,
+            PollOption.id,
+            PollOption.text,
+            PollOption.vote_count,
+        )
+        .join(PollOption, PollOption.poll == Poll.id)
+        .where(Poll.room == room)
+        .order_by(Poll.id, PollOption.id)
+        .limit(limit)
+    )
+    if after is not None:
+        query = query.where(tuple_(Poll.id, PollOption.id) > after)
+    return list(database.execute(query).tuples())
+
+
+def poll_summaries(database: Session, room: str) -> list[tuple[int, str, str, bool]]:
+    "Retrieve (id, title, description, hidden) for all polls in a room, newest first."
+    return list(
+        database.execute(
+            select(Poll.id, Poll.title, Poll.description, Poll.hidden)
+            .where(Poll.room == room)
+            .order_by(desc(Poll.created))
+        ).tuples()
+    )
 
 
-def create_new_poll(
-    database: Session, title: str, description: str, hidden: bool, options: list[str]
-) -> Poll:
+def all_poll_options(database: Session, room: str) -> list[tuple[int, int, str]]:
+    "Retrieve (poll, id, text) for the options of all polls in a room."
+    return list(
+        database.execute(
+            select(PollOption.poll, PollOption.id, PollOption.text)
+            .join(Poll, PollOption.poll == Poll.id)
+            .where(Poll.room == room)
+            .order_by(PollOption.id)
+        ).tuples()
+    )
+
+
+def create_new_poll(  # pylint: disable=too-many-arguments
+    database: Session,
+    title: str,
+    description: str,
+    hidden: bool,
+    options: list[str],
+    room: str = DEFAULT_ROOM,
+) -> schemas.Poll:
     "Create a new poll in the database."
-    poll = Poll(
-        created=datetime.now(tz=timezone.utc),
-        title=title,
-        description=description,
-        hidden=hidden,
+    new_poll = schemas.NewPoll(
+        title=title, description=description, hidden=hidden, options=options
     )
+    return create_new_polls(database, [new_poll], room)[0]
 
-    try:
-        database.add(poll)
-    except SQLAlchemyError as err:
-        database.rollback()
-        raise err
 
-    database.commit()
+def create_new_polls(
+    database: Session,
+    polls: list[schemas.NewPoll],
+    room: str = DEFAULT_ROOM,
+    commit: bool = True,
+) -> list[schemas.Poll]:
+    """
+    Create any number of polls in the database, in one transaction.
+    Polls and options are each inserted with a single statement returning
+    their ids, from which the created polls are described.
+    Without `commit`, the transaction is left for the caller to commit.
+    """
+    if not polls:
+        return []
 
-    poll_options = [PollOption(poll=poll.id, text=text) for text in options]
+    created = datetime.now(tz=timezone.utc)
     try:
-        database.add_all(poll_options)
+        poll_ids = list(
+            database.scalars(
+                insert(Poll).returning(Poll.id, sort_by_parameter_order=True),
+                [
+                    {
+                        "room": room,
+                        "created": created,
+                        "title": poll.title,
+                        "description": poll.description,
+                        "hidden": poll.hidden,
+                    }
+                    for poll in polls
+                ],
+            )
+        )
+        options = [
+            {"poll": poll_id, "text": text}
+            for (poll_id, poll) in zip(poll_ids, polls)
+            for text in poll.options
+        ]
+        option_ids: list[int] = []
+        if options:
+            option_ids = list(
+                database.scalars(
+                    insert(PollOption).returning(
+                        PollOption.id, sort_by_parameter_order=True
+                    ),
+                    options,
+                )
+            )
     except SQLAlchemyError as err:
         database.rollback()
         raise err
 
-    database.commit()
-    database.refresh(poll)
+    if commit:
+        database.commit()
 
-    return poll
+    ids = iter(option_ids)
+    return [
+        schemas.Poll(
+            id=poll_id,
+            title=poll.title,
+            description=poll.description,
+            hidden=poll.hidden,
+            options=[(text, next(ids)) for text in poll.options],
+            votes={},
+        )
+        for (poll_id, poll) in zip(poll_ids, polls)
+    ]
+
+
+def delete_poll(database: Session, poll: int, room: str) -> bool:
+    "Remove a poll of a room from the database. Returns False if there is no such poll."
+    the_poll = (
+        database.query(Poll).filter(Poll.id == poll, Poll.room == room).one_or_none()
+    )
+    if the_poll is None:
+        return False
+    database.delete(the_poll)
+    database.commit()
+    return True
 
 
-def delete_poll(database: Session, poll: int) -> None:
-    "Remove a poll from the database. Returns False on failure"
-    the_poll = database.query(Poll).filter(Poll.id == poll).one_or_none()
-    if the_poll is not None:
-        database.delete(the_poll)
-        database.commit()
+def hide_poll(database: Session, poll: int, room: str) -> bool:
+    """
+    Hide a poll of a room in the database.
+    Returns False if there is no such poll.
+    """
+    return set_poll_hidden(database, poll, room, True)
 
 
-def hide_poll(database: Session, poll: int) -> None:
+def show_poll(database: Session, poll: int, room: str) -> bool:
     """
-    Show poll in the database.
+    Show a poll of a room in the database.
+    Returns False if there is no such poll.
     """
-    db_poll = database.query(Poll).filter(Poll.id == poll).one_or_none()
+    return set_poll_hidden(database, poll, room, False)
+
+
+def set_poll_hidden(database: Session, poll: int, room: str, hidden: bool) -> bool:
+    "Hide or show a poll of a room. Returns False if there is no such poll."
+    db_poll = (
+        database.query(Poll).filter(Poll.id == poll, Poll.room == room).one_or_none()
+    )
+    if db_poll is None:
+        return False
 
     try:
-        if db_poll is not None:
-            db_poll.hidden = True
+        db_poll.hidden = hidden
         database.commit()
     except SQLAlchemyError as err:
         database.rollback()
         raise err
+    return True
+
+
+def poll_options_in_rooms(
+    database: Session, options: Collection[int]
+) -> set[tuple[int, int, str]]:
+    "The (poll, option, room) of the given poll options that exist."
+    return set(
+        database.execute(
+            select(Poll.id, PollOption.id, Poll.room)
+            .join(Poll, PollOption.poll == Poll.id)
+            .where(PollOption.id.in_(options))
+        ).tuples()
+    )
 
 
-def show_poll(database: Session, poll: int) -> None:
+def questions_in_rooms(
+    database: Session, questions: Collection[int]
+) -> set[tuple[int, str]]:
+    "The (question, room) of the given questions that exist."
+    return set(
+        database.execute(
+            select(Question.id, Question.room).where(Question.id.in_(questions))
+        ).tuples()
+    )
+
+
+def poll_vote(
+    database: Session, uid: int, poll: int, option: int, room: str
+) -> Optional[bool]:
     """
-    Show poll in the database.
+    Add a vote to a poll of a room in the database.
+    If the vote already exists, delete it.
+    Return True if a vote was added, False if it was removed,
+    None if the room has no such poll option.
     """
-    db_poll = database.query(Poll).filter(Poll.id == poll).one_or_none()
-
+    if (poll, option, room) not in poll_options_in_rooms(database, [option]):
+        return None
     try:
-        if db_poll is not None:
-            db_poll.hidden = False
+        removed = cast(
+            CursorResult[Any],
+            database.execute(
+                delete(PollVote).where(PollVote.user == uid, PollVote.option == option)
+            ),
+        ).rowcount
+        if not removed:
+            database.execute(
+                insert(PollVote).values(option=option, poll=poll, user=uid)
+            )
+
         database.commit()
     except SQLAlchemyError as err:
         database.rollback()
         raise err
 
+    return not removed
 
-def poll_vote(database: Session, uid: int, poll: int, option: int) -> None:
+
+def toggle_poll_votes(  # pylint: disable=too-many-locals
+    database: Session, toggles: list[tuple[int, int, int, str]], commit: bool = True
+) -> list[Optional[bool]]:
     """
-    Add a vote to a poll in the database.
-    If the vote already exists, delete it.
+    Toggle many (user, poll, option, room) votes, in order, in a single transaction.
+    Repeated toggles of the same vote cancel out before anything is written.
+    Return for each toggle whether it added a vote (True) or removed it (False),
+    or None if the room has no such poll option.
+    Without `commit`, the transaction is left for the caller to commit.
     """
+    found = poll_options_in_rooms(database, {option for (_, _, option, _) in toggles})
+    polls = {option: poll for (poll, option, _) in found}
+    wanted = {
+        (uid, option)
+        for (uid, poll, option, room) in toggles
+        if (poll, option, room) in found
+    }
+    # SQLite does not search an index for a row value IN, only for a plain IN.
+    voters = {uid for (uid, _) in wanted}
     try:
-        if (
-            vote := database.query(PollVote)
-            .filter(PollVote.user == uid, PollVote.option == option)
-            .one_or_none()
-        ) is None:
-            database.add(PollVote(option=option, poll=poll, user=uid))
-        else:
-            database.delete(vote)
-
-        database.commit()
+        existing = set(
+            database.execute(
+                select(PollVote.user, PollVote.option).where(
+                    PollVote.user.in_(voters),
+                    tuple_(PollVote.user, PollVote.option).in_(wanted),
+                )
+            ).tuples()
+        )
+
+        voted = set(existing)
+        added: list[Optional[bool]] = []
+        for uid, poll, option, room in toggles:
+            if (poll, option, room) not in found:
+                added.append(None)
+                continue
+            added.append((uid, option) not in voted)
+            voted ^= {(uid, option)}
+
+        if removed := existing - voted:
+            database.execute(
+                delete(PollVote).where(
+                    PollVote.user.in_(voters),
+                    tuple_(PollVote.user, PollVote.option).in_(removed),
+                )
+            )
+        if new := voted - existing:
+            database.execute(
+                insert(PollVote),
+                [
+                    {"user": uid, "poll": polls[option], "option": option}
+                    for (uid, option) in new
+                ],
+            )
+
+        if commit:
+            database.commit()
     except SQLAlchemyError as err:
         database.rollback()
         raise err
 
+    return added
 
-def poll_votes(database: Session, poll: int, option: int) -> list[PollVote]:
-    "Retrieve the votes for a given poll option"
-    return (
-        database.query(PollVote)
-        .filter(PollVote.poll == poll, PollVote.option == option)
-        .all()
-    )
+
+def poll_vote_totals(
+    database: Session,
+    options: Optional[Collection[int]] = None,
+    room: Optional[str] = None,
+) -> list[tuple[int, int, int]]:
+    """
+    The number of votes for every poll option: (poll, option, count).
+    Optionally only for the given options, or the options of polls in a room.
+    """
+    query = select(PollOption.poll, PollOption.id, PollOption.vote_count)
+    if options is not None:
+        query = query.where(PollOption.id.in_(options))
+    if room is not None:
+        query = query.join(Poll, PollOption.poll == Poll.id).where(Poll.room == room)
+    return list(database.execute(query).tuples())
 
 
 # Discussions / Q&A
 
 
-def all_discussions(database: Session) -> list[Question]:
-    "Retrieve all Q&As form the database."
-    return database.query(Question).order_by(desc(Question.created)).all()
+def discussion_summaries(
+    database: Session, room: str
+) -> list[tuple[int, str, str, str]]:
+    """
+    Retrieve (id, text, first name, last name of the asker)
+    for all Q&As in a room, newest first.
+    """
+    return list(
+        database.execute(
+            select(Question.id, Question.text, User.first_name, User.last_name)
+            .join(User, Question.user == User.id)
+            .where(Question.room == room)
+            .order_by(desc(Question.created))
+        ).tuples()
+    )
 
 
-def create_new_discussion(database: Session, user: schemas.User, text: str) -> Question:
+def all_comments(database: Session, room: str) -> list[tuple[int, int, str, str, str]]:
+    """
+    Retrieve (question, id, text, first name, last name of the commenter)
+    for all comments on Q&As in a room, newest first.
+    """
+    return list(
+        database.execute(
+            select(
+                QuestionComment.question,
+                QuestionComment.id,
+                QuestionComment.text,
+                User.first_name,
+                User.last_name,
+            )
+            .join(User, QuestionComment.user == User.id)
+            .join(Question, QuestionComment.question == Question.id)
+            .where(Question.room == room)
+            .order_by(desc(QuestionComment.created))
+        ).tuples()
+    )
+
+
+def question_transcript(
+    database: Session,
+    room: str,
+    after: Optional[tuple[int, Optional[int]]] = None,
+    limit: int = 1000,
+) -> list[tuple[int, str, str, str, int, Optional[int], str, str, str]]:
+    """
+    Retrieve (id, text, first name, last name of the asker, votes, comment id,
+    comment text, first name, last name of the commenter) for up to `limit`
+    comments on the Q&As of a room, oldest first, following the comment with
+    the (Q&A id, comment id) `after`. Each chunk is a query of its own.
+    Q&As without comments have a single row with None for the comment.
+    """
+    commenter = aliased(User)
+    query = (
+        select(
+            Question.id,
+            Question.text,
+            User.first_name,
+            User.last_name,
+            Question.vote_count,
+            QuestionComment.id,
+            QuestionComment.text,
+            commenter.first_name,
+            commenter.last_name,
+        )
+        .join(User, Question.user == User.id)
+        .outerjoin(QuestionComment, QuestionComment.question == Question.id)
+        .outerjoin(commenter, QuestionComment.user == commenter.id)
+        .where(Question.room == room)
+        .order_by(Question.id, QuestionComment.id)
+        .limit(limit)
+    )
+    if after is not None and after[1] is None:
+        # A Q&A without comments has no other rows.
+        query = query.where(Question.id > after[0])
+    elif after is not None:
+        query = query.where(tuple_(Question.id, QuestionComment.id) > after)
+    return list(database.execute(query).tuples())
+
+
+def create_new_discussion(
+    database: Session, user: schemas.User, text: str, room: str = DEFAULT_ROOM
+) -> Question:
     "Create a new Q&A in the database."
     discussion = Question(
-        created=datetime.now(tz=timezone.utc), text=text, user=user.id
+        room=room, created=datetime.now(tz=timezone.utc), text=text, user=user.id
     )
 
     try:
@@ -198,36 +575,117 @@ def create_new_discussion(database: Session, user: schemas.User, text: str) -> Q
     return discussion
 
 
-def qa_votes(database: Session, question: int) -> list[QuestionVote]:
-    "Retrieve the votes for a given Q&A"
-    return database.query(QuestionVote).filter(QuestionVote.question == question).all()
+def qa_vote_totals(
+    database: Session,
+    questions: Optional[Collection[int]] = None,
+    room: Optional[str] = None,
+) -> list[tuple[int, int]]:
+    """
+    The number of votes for every question: (question, count).
+    Optionally only for the given questions, or the questions in a room.
+    """
+    query = select(Question.id, Question.vote_count)
+    if questions is not None:
+        query = query.where(Question.id.in_(questions))
+    if room is not None:
+        query = query.where(Question.room == room)
+    return list(database.execute(query).tuples())
 
 
-def qa_vote(database: Session, uid: int, question: int) -> None:
+def qa_vote(database: Session, uid: int, question: int, room: str) -> Optional[bool]:
     """
-    Add a vote to a question in the database.
+    Add a vote to a question of a room in the database.
     If the vote already exists, delete it.
+    Return True if a vote was added, False if it was removed,
+    None if the room has no such question.
     """
+    if (question, room) not in questions_in_rooms(database, [question]):
+        return None
     try:
-        if (
-            vote := database.query(QuestionVote)
-            .filter(QuestionVote.user == uid, QuestionVote.question == question)
-            .one_or_none()
-        ) is None:
-            database.add(QuestionVote(question=question, user=uid))
-        else:
-            database.delete(vote)
+        removed = cast(
+            CursorResult[Any],
+            database.execute(
+                delete(QuestionVote).where(
+                    QuestionVote.user == uid, QuestionVote.question == question
+                )
+            ),
+        ).rowcount
+        if not removed:
+            database.execute(insert(QuestionVote).values(question=question, user=uid))
 
         database.commit()
     except SQLAlchemyError as err:
         database.rollback()
         raise err
 
+    return not removed
+
+
+def toggle_qa_votes(
+    database: Session, toggles: list[tuple[int, int, str]], commit: bool = True
+) -> list[Optional[bool]]:
+    """
+    Toggle many (user, question, room) votes, in order, in a single transaction.
+    Repeated toggles of the same vote cancel out before anything is written.
+    Return for each toggle whether it added a vote (True) or removed it (False),
+    or None if the room has no such question.
+    Without `commit`, the transaction is left for the caller to commit.
+    """
+    found = questions_in_rooms(database, {question for (_, question, _) in toggles})
+    wanted = {
+        (uid, question)
+        for (uid, question, room) in toggles
+        if (question, room) in found
+    }
+    # SQLite does not search an index for a row value IN, only for a plain IN.
+    voters = {uid for (uid, _) in wanted}
+    try:
+        existing = set(
+            database.execute(
+                select(QuestionVote.user, QuestionVote.question).where(
+                    QuestionVote.user.in_(voters),
+                    tuple_(QuestionVote.user, QuestionVote.question).in_(wanted),
+                )
+            ).tuples()
+        )
+
+        voted = set(existing)
+        added: list[Optional[bool]] = []
+        for uid, question, room in toggles:
+            if (question, room) not in found:
+                added.append(None)
+                continue
+            added.append((uid, question) not in voted)
+            voted ^= {(uid, question)}
+
+        if removed := existing - voted:
+            database.execute(
+                delete(QuestionVote).where(
+                    QuestionVote.user.in_(voters),
+                    tuple_(QuestionVote.user, QuestionVote.question).in_(removed),
+                )
+            )
+        if new := voted - existing:
+            database.execute(
+                insert(QuestionVote),
+                [{"user": uid, "question": question} for (uid, question) in new],
+            )
+
+        if commit:
+            database.commit()
+    except SQLAlchemyError as err:
+        database.rollback()
+        raise err
+
+    return added
+
 
 def qa_comment(
-    database: Session, user: schemas.User, text: str, question: int
-) -> QuestionComment:
-    "Add a comment to a Q&A in the database."
+    database: Session, user: schemas.User, text: str, question: int, room: str
+) -> Optional[QuestionComment]:
+    "Add a comment to a Q&A of a room in the database, if there is such a Q&A."
+    if (question, room) not in questions_in_rooms(database, [question]):
+        return None
     comment = QuestionComment(
         created=datetime.now(tz=timezone.utc),
         text=text,
@@ -246,9 +704,15 @@ def qa_comment(
     return comment
 
 
-def qa_delete(database: Session, question: int) -> None:
-    "Remove a Q&A from the database."
-    the_qa = database.query(Question).filter(Question.id == question).one_or_none()
-    if the_qa is not None:
-        database.delete(the_qa)
-        database.commit()
+def qa_delete(database: Session, question: int, room: str) -> bool:
+    "Remove a Q&A of a room from the database. Returns False if there is no such Q&A."
+    the_qa = (
+        database.query(Question)
+        .filter(Question.id == question, Question.room == room)
+        .one_or_none()
+    )
+    if the_qa is None:
+        return False
+    database.delete(the_qa)
+    database.commit()
+    return True
@@ -1,28 +1,251 @@
 " Database connection and setup "
 import argparse
+import asyncio
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+import re
+import sqlite3
+import sys
+from typing import Any, Callable, ContextManager, Optional, ParamSpec, TextIO, TypeVar
+from urllib.parse import urlparse
+from uuid import uuid4
 
 from rich.console import Console
 from rich.table import Table
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.orm import Session as SessionType, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 
-from app import crud
-from app.config import settings
-from app.models import Base, User
+from app import crud, decks, queryplan
+from app.config import Settings, settings
+from app.models import DEFAULT_ROOM, Base, User
+from app.schemas import ROOM_PATTERN
 
-engine = create_engine(
-    settings.database_uri,
-    future=True,
-    echo=False,
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
-)
+
+def pragmas(profile: Settings, read_only: bool = False) -> list[str]:
+    """
+    The PRAGMA statements of an SQLite engine profile. Read-only connections
+    cannot change the journal mode, which is stored in the database file.
+    They refuse to write, and read what the writer has not committed yet when
+    they share its cache: otherwise readers and writer would fail with "table
+    is locked" whenever one of them reads or writes a table the other is
+    using. See `WriterWatch` for telling whether such reads were committed.
+    """
+    statements = [
+        f"PRAGMA synchronous = {profile.sqlite_synchronous}",
+        f"PRAGMA mmap_size = {profile.sqlite_mmap_size}",
+        f"PRAGMA cache_size = {profile.sqlite_cache_size}",
+        f"PRAGMA temp_store = {profile.sqlite_temp_store}",
+    ]
+    if read_only:
+        return [*statements, "PRAGMA query_only = 1", "PRAGMA read_uncommitted = 1"]
+    return [f"PRAGMA journal_mode = {profile.sqlite_journal_mode}", *statements]
+
+
+def tune(
+    target: Engine, profile: Settings = settings, read_only: bool = False
+) -> Engine:
+    "Apply an SQLite engine profile to every new connection of an engine."
+    statements = pragmas(profile, read_only)
+
+    def configure(connection: sqlite3.Connection, _record: Any) -> None:
+        cursor = connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+    event.listen(target, "connect", configure)
+    return target
+
+
+# An in-memory database is shared by the writer and the readers through
+# SQLite's shared cache, under a name of its own.
+SHARED_MEMORY_URI = f"file:buzz-{uuid4().hex}?mode=memory&cache=shared"
+
+
+def live_engine(read_only: bool = False) -> Engine:
+    """
+    An engine for the live database: the single connection all writes go
+    through, or a pool of `database_readers` read-only connections.
+    """
+    options: dict[str, Any] = (
+        {
+            "poolclass": QueuePool,
+            "pool_size": settings.database_readers,
+            "max_overflow": 0,
+        }
+        if read_only
+        else {"poolclass": StaticPool}
+    )
+    if ":memory:" in settings.database_uri:
+        options["creator"] = lambda: sqlite3.connect(
+            SHARED_MEMORY_URI,
+            uri=True,
+            check_same_thread=False,
+            cached_statements=settings.sqlite_cached_statements,
+        )
+    return tune(
+        create_engine(
+            settings.database_uri,
+            future=True,
+            echo=False,
+            connect_args={
+                "check_same_thread": False,
+                "cached_statements": settings.sqlite_cached_statements,
+            },
+            **options,
+        ),
+        read_only=read_only,
+    )
+
+
+class WriterWatch:
+    """
+    Watches the single connection all writes go through. Readers sharing an
+    in-memory database with it also see what it has not committed yet: a read
+    was committed if the writer was not in a transaction when it started, and
+    has not changed anything (even if rolled back) by the time it ended.
+    """
+
+    connection: Optional[sqlite3.Connection]
+
+    def __init__(self) -> None:
+        self.connection = None
+
+    def connected(self, connection: sqlite3.Connection, _record: Any) -> None:
+        "Remember the connection of the writer."
+        self.connection = connection
+
+    def mark(self) -> Optional[int]:
+        "The number of changes of the writer, None while it is in a transaction."
+        if (connection := self.connection) is None:
+            return 0
+        return None if connection.in_transaction else connection.total_changes
+
+    def unchanged(self, database: SessionType, mark: Optional[int]) -> bool:
+        "Was everything read with a session since the mark was taken committed?"
+        if database.get_bind() is not reader or ":memory:" not in settings.database_uri:
+            return True
+        return mark is not None and self.mark() == mark
+
+
+engine = live_engine()
+writes = WriterWatch()
+event.listen(engine, "connect", writes.connected)
 
 Session = sessionmaker(
     bind=engine, future=True, autoflush=False, autocommit=False, expire_on_commit=False
 )
 
+# Serves /state/ and exports, next to the writes.
+reader = live_engine(read_only=True)
+
+ReadSession = sessionmaker(
+    bind=reader, future=True, autoflush=False, autocommit=False, expire_on_commit=False
+)
+
+
+def backup_path() -> str:
+    "The file system path of the backup database."
+    if urlparse(settings.backup_database_uri).path.startswith("//"):
+        return urlparse(settings.backup_database_uri).path
+    return "." + urlparse(settings.backup_database_uri).path
+
+
+# Serves reads from the backup database while the live database is restored.
+BackupSession = sessionmaker(
+    bind=tune(
+        create_engine(
+            "sqlite://",
+            future=True,
+            echo=False,
+            creator=lambda: sqlite3.connect(
+                f"{Path(backup_path()).resolve().as_uri()}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+                cached_statements=settings.sqlite_cached_statements,
+            ),
+        ),
+        read_only=True,
+    ),
+    future=True,
+    autoflush=False,
+    autocommit=False,
+)
+
+# Set once the live database has been restored and is ready for use.
+ready = asyncio.Event()
+
+executor = ThreadPoolExecutor(
+    max_workers=settings.database_threads, thread_name_prefix="database"
+)
+
+read_executor = ThreadPoolExecutor(
+    max_workers=settings.database_readers, thread_name_prefix="database-read"
+)
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+async def run_blocking(func: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+    """
+    Run blocking database work on the database executor,
+    so that the event loop keeps serving other clients in the meantime.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+async def run_reading(func: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+    """
+    Run blocking reads with a ReadSession or BackupSession on the read executor,
+    so that they do not wait for the database work queued on the database executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(read_executor, partial(func, *args, **kwargs))
+
+
+# Reads on a read-only connection that saw changes not committed yet are
+# retried this many times, and then done through the writer instead.
+READ_ATTEMPTS = 3
+
+
+class UncommittedRead(Exception):
+    "Every attempt of a read saw changes that were not committed yet."
+
+
+def read_committed(read: Callable[[SessionType], T], database: SessionType) -> T:
+    "Do a read with a session, again as long as it sees uncommitted changes."
+    for _ in range(READ_ATTEMPTS):
+        mark = writes.mark()
+        result = read(database)
+        if writes.unchanged(database, mark):
+            return result
+    raise UncommittedRead()
+
+
+def read_through_writer(read: Callable[[SessionType], T]) -> T:
+    "Do a read through the writer, which only sees what it committed."
+    with Session() as database:
+        return read(database)
+
+
+async def run_committed(read: Callable[[SessionType], T], database: SessionType) -> T:
+    """
+    Do a read with a ReadSession or BackupSession on the read executor, like
+    `run_reading`, but never return changes that were not committed yet:
+    the read is retried, and finally done through the writer.
+    """
+    try:
+        return await run_reading(read_committed, read, database)
+    except UncommittedRead:
+        return await run_blocking(read_through_writer, read)
+
 
 def build() -> None:
     "Manually rebuild a fresh database."
@@ -45,10 +268,39 @@ def admin() -> None:
         required=False,
         help="Name of the user to operate on",
     )
+    parser.add_argument(
+        "-f",
+        "--file",
+        type=str,
+        required=False,
+        help="Deck of polls to import or export to (default: standard in/out)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["ndjson", "csv"],
+        required=False,
+        help="Format of the deck (default: from the file name, or ndjson)",
+    )
+    parser.add_argument(
+        "-r", "--room", type=str, default=DEFAULT_ROOM, help="Room to operate on"
+    )
+    parser.add_argument(
+        "--chunk", type=int, default=500, help="Polls to insert at a time"
+    )
 
     args = parser.parse_args()
+    if re.match(ROOM_PATTERN, args.room) is None:
+        parser.error(f"Invalid room: {args.room}")
+    format_ = args.format or decks.guess_format(args.file or "")
 
-    admin_engine = create_engine(settings.backup_database_uri, future=True, echo=False)
+    admin_engine = tune(
+        create_engine(
+            settings.backup_database_uri,
+            future=True,
+            echo=False,
+            connect_args={"cached_statements": settings.sqlite_cached_statements},
+        )
+    )
     admin_session = sessionmaker(bind=admin_engine)
 
     if args.operation == "list_users":
@@ -71,5 +323,56 @@ def admin() -> None:
 
     elif args.operation == "create_user":
         with admin_session() as database:
-            first_name, last_name = args.split(" ", 1)
+            first_name, last_name = args.user_name.split(" ", 1)
             crud.create_user(database, args.user, first_name, last_name, None)
+
+    elif args.operation == "import_polls":
+        # Read, validate and insert one chunk at a time: memory use does not
+        # depend on the size of the deck. The deck is committed as a whole,
+        # so a deck with an invalid poll imports nothing.
+        with deck_file(args.file, "r") as file, admin_session() as database:
+            imported = 0
+            try:
+                for chunk in decks.chunks(decks.read(file, format_), args.chunk):
+                    crud.create_new_polls(database, chunk, args.room, commit=False)
+                    imported += len(chunk)
+            except ValueError as err:
+                sys.exit(f"Nothing imported: {err}")
+            database.commit()
+        Console(stderr=True).print(f"Imported {imported} polls into {args.room}")
+
+    elif args.operation == "export":
+        with deck_file(args.file, "w") as file, admin_session() as database:
+            decks.write(crud.deck(database, args.room), file, format_)
+
+    elif args.operation == "check_query_plans":
+        check_query_plans()
+
+    else:
+        parser.error(f"Unknown operation: {args.operation}")
+
+
+def check_query_plans() -> None:
+    """
+    Report the hot queries doing full table scans against the schema of the
+    backup database, as migrated, and exit with an error if there are any.
+    """
+    problems = queryplan.check(queryplan.schema_of(sqlite3.connect(backup_path())))
+    console = Console()
+    for name, statements in problems.items():
+        for statement, plan in statements:
+            console.print(f"[bold]{name}[/bold]: {' '.join(statement.split())}")
+            for step in plan:
+                console.print(f"  {step}", highlight=False)
+    if problems:
+        sys.exit(1)
+    console.print("All hot queries are served by indexes")
+
+
+def deck_file(path: Optional[str], mode: str) -> ContextManager[TextIO]:
+    "Open a deck file, or use standard in/out when there is no path."
+    if path is None:
+        return nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    if mode == "r":
+        return open(path, "r", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
@@ -0,0 +1,82 @@
+" Reading and writing decks of prepared polls as NDJSON or CSV "
+
+import csv
+from collections.abc import Iterable, Iterator
+from itertools import islice
+import json
+from typing import Literal, TextIO
+
+from pydantic import ValidationError
+
+from app.schemas import NewPoll
+
+Format = Literal["ndjson", "csv"]
+
+# CSV decks have one poll per row: these columns, followed by one column per option.
+CSV_HEADER = ["title", "description", "hidden"]
+
+
+def guess_format(path: str) -> Format:
+    "The format of a deck file, from its name."
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+
+def read(file: TextIO, format_: Format) -> Iterator[NewPoll]:
+    """
+    Read the polls of a deck one at a time.
+    Raises a ValueError naming the line of the first poll that is not valid.
+    """
+    if format_ == "csv":
+        rows = csv.reader(file)
+        header = next(rows, None)
+        if header is not None and header[: len(CSV_HEADER)] != CSV_HEADER:
+            raise ValueError(f"Expected a CSV header starting with {CSV_HEADER}")
+        for row in rows:
+            if not row:
+                continue
+            if len(row) < len(CSV_HEADER):
+                raise ValueError(
+                    f"Line {rows.line_num}: expected at least the columns {CSV_HEADER}"
+                )
+            try:
+                poll = NewPoll.parse_obj(
+                    {
+                        "title": row[0],
+                        "description": row[1],
+                        "hidden": row[2] or False,
+                        "options": [option for option in row[3:] if option],
+                    }
+                )
+            except ValidationError as err:
+                raise ValueError(f"Line {rows.line_num}: {err}") from err
+            yield poll
+    else:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                poll = NewPoll.parse_raw(line)
+            except ValidationError as err:
+                raise ValueError(f"Line {number}: {err}") from err
+            yield poll
+
+
+def write(polls: Iterable[NewPoll], file: TextIO, format_: Format) -> None:
+    "Write the polls of a deck one at a time."
+    if format_ == "csv":
+        writer = csv.writer(file)
+        writer.writerow(CSV_HEADER)
+        for poll in polls:
+            writer.writerow(
+                [poll.title, poll.description, str(poll.hidden).lower(), *poll.options]
+            )
+    else:
+        for poll in polls:
+            file.write(json.dumps(poll.dict()) + "\n")
+
+
+def chunks(polls: Iterable[NewPoll], size: int) -> Iterator[list[NewPoll]]:
+    "Split a deck into lists of at most `size` polls."
+    iterator = iter(polls)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
@@ -1,26 +1,47 @@
 " Provide Depends() objects for all API endpoints "
 
-from typing import Generator
-from datetime import datetime, timezone
+from typing import AsyncGenerator
 
 from fastapi import Depends, Header, HTTPException, status
 from fastapi.security.utils import get_authorization_scheme_param
-from jose import jwt
-from jose.exceptions import JWTError
 from sqlalchemy.orm import Session as SessionType
 
-from app.config import settings
-from app.database import Session
+from app.authorization import AuthorizationError, user_from_token
+from app.database import (
+    BackupSession,
+    ReadSession,
+    Session,
+    ready,
+    run_blocking,
+    run_reading,
+)
 from app.schemas import User
 
 
-def get_db() -> Generator[SessionType, None, None]:
-    "Provide access to the database"
+async def get_db() -> AsyncGenerator[SessionType, None]:
+    """
+    Provide access to the database.
+    The session is closed by the database threads: closing it elsewhere could
+    roll back work of other sessions sharing the same SQLite connection.
+    """
+    database = Session()
     try:
-        database = Session()
         yield database
     finally:
-        database.close()
+        await run_blocking(database.close)
+
+
+async def get_read_db() -> AsyncGenerator[SessionType, None]:
+    """
+    Provide read-only access to the database, through one of the read-only
+    connections: use it on the read executor, with `run_reading`.
+    While the live database is still being restored, reads come from the backup.
+    """
+    database = ReadSession() if ready.is_set() else BackupSession()
+    try:
+        yield database
+    finally:
+        await run_reading(database.close)
 
 
 def current_user(authorization: str = Header()) -> User:
@@ -34,21 +55,12 @@ def current_user(authorization: str = Header()) -> User:
         )
 
     try:
-        payload = jwt.decode(token, settings.api_secret, "HS256")
-    except JWTError as err:
+        return user_from_token(token)
+    except AuthorizationError as err:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN, detail=f"Decoding JWT: {err}"
+            status_code=status.HTTP_403_FORBIDDEN, detail=str(err)
         ) from err
 
-    expiry = datetime.fromtimestamp(payload["exp"], tz=timezone.utc)
-    current_time = datetime.now(tz=timezone.utc)
-    if expiry < current_time:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN, detail="Credentials expired"
-        )
-
-    return User(**payload)
-
 
 def current_admin(user: User = Depends(current_user)) -> User:
     """
@@ -0,0 +1,192 @@
+" Streaming exports of poll results and Q&A transcripts "
+
+from collections.abc import AsyncIterator, Callable, Sequence
+from functools import partial
+from operator import itemgetter
+import csv
+import io
+import json
+from typing import Any, Literal, Optional, TypeVar
+
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+
+from app import crud, deps
+from app.database import run_committed
+from app.models import DEFAULT_ROOM
+from app.schemas import ROOM_PATTERN, User
+
+router = APIRouter()
+
+Format = Literal["ndjson", "csv"]
+
+Row = TypeVar("Row", bound=tuple[Any, ...])
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+POLL_COLUMNS = ["poll", "title", "option", "text", "votes"]
+
+QUESTION_COLUMNS = [
+    "qa",
+    "text",
+    "user",
+    "votes",
+    "comment",
+    "comment_text",
+    "comment_user",
+]
+
+
+async def fetch(
+    read: Callable[..., Sequence[Row]],
+    database: Session,
+    room: str,
+    key: Callable[[Row], tuple[Any, ...]],
+) -> AsyncIterator[Sequence[Row]]:
+    """
+    Fetch rows a chunk at a time, each chunk following the `key` of the last
+    row of the one before. Like /state/, every chunk only holds committed data,
+    and the database is never touched from the threads serving the response.
+    """
+    after = None
+    while chunk := await run_committed(partial(read, room=room, after=after), database):
+        yield chunk
+        after = key(chunk[-1])
+
+
+def csv_lines(rows: Sequence[Sequence[Any]]) -> str:
+    "Format rows as CSV."
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def streaming(
+    body: AsyncIterator[str], room: str, name: str, format_: Format
+) -> StreamingResponse:
+    "Send an export as it is produced, as a file download."
+    return StreamingResponse(
+        body,
+        media_type=MEDIA_TYPES[format_],
+        headers={
+            "Content-Disposition": f'attachment; filename="{room}-{name}.{format_}"'
+        },
+    )
+
+
+async def poll_lines(
+    chunks: AsyncIterator[Sequence[tuple[int, str, int, str, int]]], format_: Format
+) -> AsyncIterator[str]:
+    "One line per poll option."
+    if format_ == "csv":
+        yield csv_lines([POLL_COLUMNS])
+    async for chunk in chunks:
+        if format_ == "csv":
+            yield csv_lines(chunk)
+        else:
+            yield "".join(
+                json.dumps(dict(zip(POLL_COLUMNS, row))) + "\n" for row in chunk
+            )
+
+
+QuestionRows = AsyncIterator[
+    Sequence[tuple[int, str, str, str, int, Optional[int], str, str, str]]
+]
+
+
+async def question_csv(chunks: QuestionRows) -> AsyncIterator[str]:
+    "One line per comment, or per Q&A without comments."
+    yield csv_lines([QUESTION_COLUMNS])
+    async for chunk in chunks:
+        yield csv_lines(
+            [
+                (
+                    question,
+                    text,
+                    f"{first} {last}",
+                    votes,
+                    comment,
+                    comment_text,
+                    f"{comment_first} {comment_last}" if comment is not None else None,
+                )
+                for (
+                    question,
+                    text,
+                    first,
+                    last,
+                    votes,
+                    comment,
+                    comment_text,
+                    comment_first,
+                    comment_last,
+                ) in chunk
+            ]
+        )
+
+
+async def question_ndjson(chunks: QuestionRows) -> AsyncIterator[str]:
+    "One line per Q&A, with its comments."
+    current: dict[str, Any] = {}
+    async for chunk in chunks:
+        lines = []
+        for (
+            question,
+            text,
+            first,
+            last,
+            votes,
+            comment,
+            comment_text,
+            comment_first,
+            comment_last,
+        ) in chunk:
+            # The comments of a Q&A are consecutive rows, possibly across chunks.
+            if current.get("id") != question:
+                if current:
+                    lines.append(json.dumps(current) + "\n")
+                current = {
+                    "id": question,
+                    "text": text,
+                    "user": f"{first} {last}",
+                    "votes": votes,
+                    "comments": [],
+                }
+            if comment is not None:
+                current["comments"].append(
+                    {
+                        "id": comment,
+                        "text": comment_text,
+                        "user": f"{comment_first} {comment_last}",
+                    }
+                )
+        if lines:
+            yield "".join(lines)
+
+    if current:
+        yield json.dumps(current) + "\n"
+
+
+@router.get("/polls")
+async def export_polls(
+    room: str = Query(default=DEFAULT_ROOM, regex=ROOM_PATTERN),
+    format_: Format = Query(default="ndjson", alias="format"),
+    database: Session = Depends(deps.get_read_db),
+    _admin: User = Depends(deps.current_admin),
+) -> StreamingResponse:
+    "Vote tallies of every poll option in a room, streamed as NDJSON or CSV."
+    chunks = fetch(crud.poll_results, database, room, itemgetter(0, 2))
+    return streaming(poll_lines(chunks, format_), room, "polls", format_)
+
+
+@router.get("/qas")
+async def export_questions(
+    room: str = Query(default=DEFAULT_ROOM, regex=ROOM_PATTERN),
+    format_: Format = Query(default="ndjson", alias="format"),
+    database: Session = Depends(deps.get_read_db),
+    _admin: User = Depends(deps.current_admin),
+) -> StreamingResponse:
+    "Q&As of a room, with vote counts and comment threads, streamed as NDJSON or CSV."
+    chunks = fetch(crud.question_transcript, database, room, itemgetter(0, 5))
+    lines = question_csv if format_ == "csv" else question_ndjson
+    return streaming(lines(chunks), room, "qas", format_)
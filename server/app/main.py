@@ -2,48 +2,121 @@
 Main entry point
 """
 
+import asyncio
 from collections.abc import AsyncGenerator
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 import logging
+import os
+import signal
 import sqlite3
-from urllib.parse import urlparse
+from typing import Optional
 
 from fastapi import APIRouter, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app import auth, database, realtime, state
+from app import (
+    auth,
+    crud,
+    database,
+    export,
+    metrics,
+    oidc,
+    persistence,
+    realtime,
+    state,
+)
 from app.config import settings
+from app.tally import tally
+from app.users import users
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 
+def warm_caches() -> None:
+    "Load in-memory caches from the live database."
+    with database.Session() as session:
+        tally.warm(session)
+        users.warm(crud.all_users(session))
+
+
+async def restore(live_database_connection: Optional[sqlite3.Connection]) -> None:
+    """
+    Restore the database to :memory: in a worker thread,
+    then mark the database as ready for use.
+    """
+    if live_database_connection is not None:
+        log.debug("Restoring database from disk...")
+        await asyncio.to_thread(persistence.restore, live_database_connection)
+
+    await database.run_blocking(warm_caches)
+    database.ready.set()
+    log.debug("Database ready")
+
+
+def restored(task: "asyncio.Task[None]") -> None:
+    """
+    Stop the server when restoring the database failed while already serving:
+    it would never become ready, and every login and handshake would hang.
+    """
+    if task.cancelled() or (err := task.exception()) is None:
+        return
+    log.critical("Restoring the database failed: %s", err)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
 @asynccontextmanager
 async def lifespan(_app: FastAPI) -> AsyncGenerator[None, None]:
     """
-    Restore the database to :memory: on startup, and
-    Backup the :memory: database on shutdown.
+    Restore the database to :memory: on startup,
+    Backup the :memory: database periodically and on shutdown.
+    With `serve_during_restore`, start serving before the restore has finished:
+    in the meantime /state/ is read from the backup database.
     See: https://www.sqlite.org/backup.html
     """
-    if urlparse(settings.backup_database_uri).path.startswith("//"):
-        path = urlparse(settings.backup_database_uri).path
+    live_database_connection = persistence.in_memory_connection()
+    if live_database_connection is not None and settings.broadcast_bus != "local":
+        raise RuntimeError(
+            "A broadcast bus shares broadcasts between server processes, "
+            "which then also need a shared database_uri instead of :memory:"
+        )
+
+    restoring = asyncio.create_task(restore(live_database_connection))
+    if settings.serve_during_restore:
+        restoring.add_done_callback(restored)
     else:
-        path = "." + urlparse(settings.backup_database_uri).path
-    live_database_connection = database.engine.raw_connection().driver_connection
+        await restoring
 
-    if ":memory:" in settings.database_uri:
-        log.debug("Restoring database from disk...")
-        restore = sqlite3.connect(path)
-        if live_database_connection is not None:
-            restore.backup(target=live_database_connection)
+    await realtime.manager.start()
+    oidc.connection.start()
+
+    saver = None
+    if live_database_connection is not None and settings.backup_interval > 0:
+        saver = asyncio.create_task(
+            persistence.save_periodically(live_database_connection)
+        )
 
     yield
 
-    if ":memory:" in settings.database_uri:
+    with suppress(Exception):
+        await restoring
+
+    if saver is not None:
+        saver.cancel()
+        with suppress(asyncio.CancelledError):
+            await saver
+
+    realtime.ticker.stop()
+    await realtime.manager.stop()
+    await oidc.connection.stop()
+    database.executor.shutdown(wait=True)
+    database.read_executor.shutdown(wait=True)
+    database.reader.dispose()
+
+    # Saving a database that failed to restore would overwrite the backup.
+    if live_database_connection is not None and database.ready.is_set():
         log.debug("Saving database to disk...")
-        backup = sqlite3.connect(path)
-        if live_database_connection is not None:
-            live_database_connection.backup(target=backup)
+        await asyncio.to_thread(persistence.save, live_database_connection)
 
 
 app = FastAPI(lifespan=lifespan)
@@ -59,6 +132,8 @@ app.add_middleware(
 router = APIRouter()
 router.include_router(auth.router, prefix="/auth")
 router.include_router(state.router, prefix="/state")
+router.include_router(export.router, prefix="/export")
+router.include_router(metrics.router, prefix="/metrics")
 router.include_router(realtime.router)
 
 app.include_router(router)
@@ -0,0 +1,38 @@
+" Runtime counters and gauges for monitoring a running server "
+
+from threading import Lock
+
+from fastapi import APIRouter, Depends
+
+from app import deps
+from app.authorization import tokens
+from app.schemas import User
+
+router = APIRouter()
+
+_lock = Lock()
+_values: dict[str, float] = {}
+
+
+def increment(name: str, amount: float = 1) -> None:
+    "Add to a counter, starting from zero."
+    with _lock:
+        _values[name] = _values.get(name, 0) + amount
+
+
+def gauge(name: str, value: float) -> None:
+    "Record the current value of a measurement."
+    with _lock:
+        _values[name] = value
+
+
+def snapshot() -> dict[str, float]:
+    "A copy of all counters and gauges."
+    with _lock:
+        return dict(sorted(_values.items()))
+
+
+@router.get("/")
+def get_metrics(_admin: User = Depends(deps.current_admin)) -> dict[str, float]:
+    "Current values of all runtime counters and gauges."
+    return snapshot() | tokens.statistics()
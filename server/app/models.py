@@ -1,7 +1,17 @@
 " Database models: declarative SQL table descriptions "
 # pylint: disable=too-few-public-methods
 
-from sqlalchemy import DateTime, ForeignKey, Integer, String, UniqueConstraint, Boolean
+from sqlalchemy import (
+    DDL,
+    Boolean,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    UniqueConstraint,
+    event,
+)
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -9,6 +19,10 @@ class Base(DeclarativeBase):
     "Base class for SQLAlchemy."
 
 
+# Polls and questions belong to a room: clients only see those of the room they joined.
+DEFAULT_ROOM = "default"
+
+
 # Authentication
 
 
@@ -33,8 +47,10 @@ class User(Base):
 class Poll(Base):
     "Table for recording polls."
     __tablename__ = "polls"
+    __table_args__ = (Index("ix_polls_room_created", "room", "created"),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    room = mapped_column(String, nullable=False, server_default=DEFAULT_ROOM)
     created = mapped_column(DateTime, nullable=False)
     title = mapped_column(String, nullable=False)
     description = mapped_column(String)
@@ -48,10 +64,12 @@ class Poll(Base):
 class PollOption(Base):
     "Table for recording poll options."
     __tablename__ = "poll_options"
+    __table_args__ = (Index("ix_poll_options_poll", "poll"),)
 
     id = mapped_column(Integer, primary_key=True)
     poll = mapped_column(Integer, ForeignKey("polls.id"), nullable=False)
     text = mapped_column(String, nullable=False)
+    vote_count = mapped_column(Integer, nullable=False, server_default="0")
 
 
 class PollVote(Base):
@@ -59,6 +77,8 @@ class PollVote(Base):
     __tablename__ = "poll_votes"
     __table_args__ = (
         UniqueConstraint("option", "poll", "user", name="one_vote_per_user_per_option"),
+        Index("ix_poll_votes_poll_option", "poll", "option"),
+        Index("ix_poll_votes_user_option", "user", "option"),
     )
 
     id = mapped_column(Integer, primary_key=True)
@@ -73,11 +93,14 @@ class PollVote(Base):
 class Question(Base):
     "Q&A questions."
     __tablename__ = "questions"
+    __table_args__ = (Index("ix_questions_room_created", "room", "created"),)
 
     id = mapped_column(Integer, primary_key=True)
+    room = mapped_column(String, nullable=False, server_default=DEFAULT_ROOM)
     text = mapped_column(String, nullable=False)
     created = mapped_column(DateTime, nullable=False)
     user = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
+    vote_count = mapped_column(Integer, nullable=False, server_default="0")
     asker: Mapped[User] = relationship("User")
     votes: Mapped[list["QuestionVote"]] = relationship(
         "QuestionVote",
@@ -93,6 +116,9 @@ class Question(Base):
 class QuestionComment(Base):
     "Comments or responses to questions"
     __tablename__ = "question_comments"
+    __table_args__ = (
+        Index("ix_question_comments_question_created", "question", "created"),
+    )
 
     id = mapped_column(Integer, primary_key=True)
     created = mapped_column(DateTime, nullable=False)
@@ -105,8 +131,66 @@ class QuestionComment(Base):
 class QuestionVote(Base):
     "Table for recording votes on questions."
     __tablename__ = "question_votes"
-    __table_args__ = (UniqueConstraint("question", "user", name="one_vote_per_user"),)
+    __table_args__ = (
+        UniqueConstraint("question", "user", name="one_vote_per_user"),
+        Index("ix_question_votes_user_question", "user", "question"),
+    )
 
     id = mapped_column(Integer, primary_key=True)
     question = mapped_column(Integer, ForeignKey("questions.id"), nullable=False)
     user = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
+
+
+# Vote counts
+
+# The vote_count columns are kept in sync with the votes by the database itself,
+# in the same transaction as the votes, however the votes are changed.
+VOTE_COUNT_TRIGGERS = {
+    PollVote.__table__: [
+        """
+        CREATE TRIGGER poll_votes_count_insert AFTER INSERT ON poll_votes
+        BEGIN
+            UPDATE poll_options SET vote_count = vote_count + 1 WHERE id = NEW.option;
+        END
+        """,
+        """
+        CREATE TRIGGER poll_votes_count_delete AFTER DELETE ON poll_votes
+        BEGIN
+            UPDATE poll_options SET vote_count = vote_count - 1 WHERE id = OLD.option;
+        END
+        """,
+        """
+        CREATE TRIGGER poll_votes_count_update AFTER UPDATE OF option ON poll_votes
+        BEGIN
+            UPDATE poll_options SET vote_count = vote_count - 1 WHERE id = OLD.option;
+            UPDATE poll_options SET vote_count = vote_count + 1 WHERE id = NEW.option;
+        END
+        """,
+    ],
+    QuestionVote.__table__: [
+        """
+        CREATE TRIGGER question_votes_count_insert AFTER INSERT ON question_votes
+        BEGIN
+            UPDATE questions SET vote_count = vote_count + 1 WHERE id = NEW.question;
+        END
+        """,
+        """
+        CREATE TRIGGER question_votes_count_delete AFTER DELETE ON question_votes
+        BEGIN
+            UPDATE questions SET vote_count = vote_count - 1 WHERE id = OLD.question;
+        END
+        """,
+        """
+        CREATE TRIGGER question_votes_count_update
+        AFTER UPDATE OF question ON question_votes
+        BEGIN
+            UPDATE questions SET vote_count = vote_count - 1 WHERE id = OLD.question;
+            UPDATE questions SET vote_count = vote_count + 1 WHERE id = NEW.question;
+        END
+        """,
+    ],
+}
+
+for table, triggers in VOTE_COUNT_TRIGGERS.items():
+    for trigger in triggers:
+        event.listen(table, "after_create", DDL(trigger))  # type: ignore[no-untyped-call]
@@ -1,50 +1,185 @@
 " Abstraction for OpenID Connect and the VIB Services API "
 
 import asyncio
+from contextlib import suppress
+import logging
+import time
+from typing import Any, Optional
 
 import httpx
+from jose import jwt
+from jose.exceptions import JWTError
 
+from app import metrics
 from app.config import settings
 
 Token = dict[str, str]
-Jwks = dict[str, str]
+Jwks = dict[str, Any]
 
+log = logging.getLogger(__name__)
 
-async def token(code: str, redirect: str) -> tuple[Token, Jwks]:
+# A token signed with a key that is not in the cached JWKS makes us fetch the
+# JWKS again, but at most this often (in seconds): made up key ids should not
+# make us hammer the provider.
+MIN_REFRESH_INTERVAL = 10.0
+
+
+class Connection:
     """
-    Retrieve token from VIB services given an authorization code from the client.
-    Get VIB Services keys in parallel.
-    """
-    async with httpx.AsyncClient() as client:
-        [tkn, jwks] = await asyncio.gather(
-            asyncio.ensure_future(
-                client.post(
-                    "https://services.vib.be/connect/token",
-                    data={
-                        "client_id": "training_vote",
-                        "client_secret": settings.client_secret,
-                        "grant_type": "authorization_code",
-                        "code": code,
-                        "state": "",
-                        "scope": "openid profile email userroles roles",
-                        "redirect_uri": redirect,
-                    },
-                )
-            ),
-            asyncio.ensure_future(
-                client.get(
-                    "https://services.vib.be/.well-known/openid-configuration/jwks"
-                )
+    A pool of HTTP connections to the OpenID Connect provider, kept open for
+    the lifetime of the application, so logins reuse connections (and TLS
+    sessions) instead of opening new ones.
+    """
+
+    client: Optional[httpx.AsyncClient]
+
+    def __init__(self) -> None:
+        self.client = None
+
+    def start(self) -> None:
+        "Open the connection pool."
+        self.client = httpx.AsyncClient(
+            base_url=settings.oidc_issuer,
+            limits=httpx.Limits(
+                max_connections=settings.oidc_connections,
+                max_keepalive_connections=settings.oidc_connections,
             ),
+            timeout=settings.oidc_timeout,
         )
-        return (tkn.json(), jwks.json())
+
+    async def stop(self) -> None:
+        "Close all pooled connections."
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def http(self) -> httpx.AsyncClient:
+        "The pooled HTTP client."
+        if self.client is None:
+            raise RuntimeError("The OpenID Connect client has not been started")
+        return self.client
+
+
+connection = Connection()
+
+
+def max_age(headers: httpx.Headers) -> float:
+    """
+    For how many seconds a response may be cached, according to its
+    Cache-Control and Age headers. Without a Cache-Control header,
+    `settings.oidc_jwks_max_age` is used.
+    """
+    cache_control = headers.get("cache-control")
+    if cache_control is None:
+        return settings.oidc_jwks_max_age
+
+    directives = [part.strip().lower() for part in cache_control.split(",")]
+    if "no-store" in directives or "no-cache" in directives:
+        return 0
+
+    for directive in directives:
+        if directive.startswith("max-age="):
+            with suppress(ValueError):
+                age = float(headers.get("age", 0))
+                return max(0, float(directive.removeprefix("max-age=")) - age)
+
+    return settings.oidc_jwks_max_age
+
+
+class KeySet:
+    """
+    The signing keys (JWKS) of the OpenID Connect provider, fetched once and
+    kept for as long as the provider allows, or until a token turns up that
+    was signed with a key we do not know yet.
+    """
+
+    keys: Jwks
+    expires: float
+    fetched: float
+    lock: asyncio.Lock
+
+    def __init__(self) -> None:
+        self.keys = {"keys": []}
+        self.expires = 0
+        self.fetched = -MIN_REFRESH_INTERVAL
+        self.lock = asyncio.Lock()
+
+    def fresh(self) -> bool:
+        "Have the keys not expired yet?"
+        return time.monotonic() < self.expires
+
+    def known(self, kid: Optional[str]) -> bool:
+        "Is a key id in the key set? Any key will do when there is no key id."
+        return kid is None or any(
+            key.get("kid") == kid for key in self.keys.get("keys", [])
+        )
+
+    async def get(self, kid: Optional[str] = None) -> Jwks:
+        "The key set, fetching it if it expired or does not contain a key id."
+        if self.fresh() and self.known(kid):
+            return self.keys
+
+        async with self.lock:
+            # Another login may have fetched the keys while we were waiting.
+            recently = time.monotonic() - self.fetched < MIN_REFRESH_INTERVAL
+            if not self.fresh() or (not self.known(kid) and not recently):
+                await self.fetch()
+            return self.keys
+
+    async def fetch(self) -> None:
+        "Download the key set."
+        log.info("Fetching JWKS from %s", settings.oidc_issuer)
+        metrics.increment("oidc_jwks_fetches")
+        response = await connection.http().get("/.well-known/openid-configuration/jwks")
+        response.raise_for_status()
+
+        self.keys = response.json()
+        self.fetched = time.monotonic()
+        self.expires = self.fetched + max_age(response.headers)
+
+
+keys = KeySet()
+
+
+def key_id(id_token: str) -> Optional[str]:
+    "The id of the key an id token was signed with, if any."
+    with suppress(JWTError):
+        kid = jwt.get_unverified_header(id_token).get("kid")
+        return kid if isinstance(kid, str) else None
+    return None
+
+
+async def token(code: str, redirect: str) -> tuple[Token, Jwks]:
+    """
+    Retrieve token from VIB services given an authorization code from the client.
+    Get VIB Services keys in parallel, if they are not cached.
+    """
+    [response, jwks] = await asyncio.gather(
+        connection.http().post(
+            "/connect/token",
+            data={
+                "client_id": "training_vote",
+                "client_secret": settings.client_secret,
+                "grant_type": "authorization_code",
+                "code": code,
+                "state": "",
+                "scope": "openid profile email userroles roles",
+                "redirect_uri": redirect,
+            },
+        ),
+        keys.get(),
+    )
+    tkn = response.json()
+
+    if "id_token" in tkn:
+        jwks = await keys.get(key_id(tkn["id_token"]))
+    return (tkn, jwks)
 
 
 async def user_info(access_token: str) -> dict[str, str]:
     "Retrieve authenticated user information from VIB Services."
-    async with httpx.AsyncClient() as client:
-        info = await client.get(
-            "https://services.vib.be/connect/userinfo",
-            headers={"Authorization": f"Bearer {access_token}"},
-        )
-        return info.json()  # type: ignore[no-any-return]
+    info = await connection.http().get(
+        "/connect/userinfo",
+        headers={"Authorization": f"Bearer {access_token}"},
+    )
+    return info.json()  # type: ignore[no-any-return]
@@ -0,0 +1,87 @@
+" Keeping the on-disk copy of an in-memory database up to date "
+
+import asyncio
+from contextlib import closing
+import logging
+import sqlite3
+from threading import Lock
+from typing import Callable, Optional
+
+from app import metrics
+from app.config import settings
+from app.database import backup_path, engine, ready
+
+log = logging.getLogger(__name__)
+
+# A periodic save can still be running in its thread when the final save starts.
+saving = Lock()
+
+
+def in_memory_connection() -> Optional[sqlite3.Connection]:
+    "The SQLite connection of the live database, if it is an in-memory database."
+    connection = engine.raw_connection().driver_connection
+    if ":memory:" in settings.database_uri and isinstance(
+        connection, sqlite3.Connection
+    ):
+        return connection
+    return None
+
+
+def progress(operation: str) -> Callable[[int, int, int], None]:
+    "Report the progress of copying a database as a log message and a metric."
+
+    def report(_status: int, remaining: int, total: int) -> None:
+        log.info("%s: %d of %d pages copied", operation, total - remaining, total)
+        metrics.gauge(f"database_{operation}_progress", 1 - remaining / max(total, 1))
+
+    return report
+
+
+def restore(live: sqlite3.Connection) -> None:
+    """
+    Copy the backup database from disk into the live database.
+    The copy proceeds `backup_pages` pages at a time.
+    """
+    with closing(sqlite3.connect(backup_path())) as backup:
+        backup.backup(
+            live,
+            pages=settings.backup_pages,
+            sleep=settings.backup_sleep,
+            progress=progress("restore"),
+        )
+
+
+def save(live: sqlite3.Connection) -> None:
+    """
+    Copy the live database to disk.
+    The copy proceeds `backup_pages` pages at a time, sleeping `backup_sleep`
+    seconds in between, so that the live database is never locked for long.
+    Writes to the live database during the copy are included in the copy.
+    """
+    with saving, closing(sqlite3.connect(backup_path())) as backup:
+        live.backup(
+            backup,
+            pages=settings.backup_pages,
+            sleep=settings.backup_sleep,
+            progress=progress("backup"),
+        )
+
+
+async def save_periodically(live: sqlite3.Connection) -> None:
+    """
+    Copy the live database to disk every `backup_interval` seconds, if it changed,
+    so at most that much data is lost when the server does not shut down cleanly.
+    """
+    await ready.wait()
+    saved_changes = live.total_changes
+    while True:
+        await asyncio.sleep(settings.backup_interval)
+        if live.total_changes == saved_changes:
+            continue
+
+        log.debug("Saving database to disk...")
+        saved_changes = live.total_changes
+        try:
+            await asyncio.to_thread(save, live)
+        except sqlite3.Error as err:
+            log.error("Saving database to disk failed: %s", err)
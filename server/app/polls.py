@@ -1,10 +1,15 @@
 " Poll control functions and HTTP API "
 
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
 
 from app import crud
+from app.batching import PollToggle
 from app.client import error, Package
-from app.schemas import User
+from app.config import settings
+from app.models import DEFAULT_ROOM
+from app.schemas import NewPoll, User
+from app.tally import tally
 
 Arguments = dict[str, str | int | list[str]]
 
@@ -19,6 +24,7 @@ def create_new_poll(
     description = args.get("description")
     hidden = args.get("hidden")
     options = args.get("options")
+    room = str(args.get("room", DEFAULT_ROOM))
 
     try:
         if (
@@ -28,13 +34,15 @@ def create_new_poll(
             and isinstance(hidden, bool)
             and all(isinstance(option, str) for option in options)
         ):
-            poll = crud.create_new_poll(database, title, description, hidden, options)
+            poll = crud.create_new_poll(
+                database, title, description, hidden, options, room
+            )
             return {
                 "id": poll.id,
                 "title": poll.title,
                 "description": poll.description,
                 "hidden": poll.hidden,
-                "options": [(opt.text, opt.id) for opt in poll.options],
+                "options": poll.options,
             }
 
         return error("type mismatch")
@@ -42,12 +50,37 @@ def create_new_poll(
         return error(str(err))
 
 
+def create_new_polls(
+    database: Session,
+    _user: User,
+    args: Arguments,
+) -> Package:
+    "Create a deck of polls in the database at once and format a reponse."
+    polls = args.get("polls")
+    room = str(args.get("room", DEFAULT_ROOM))
+
+    try:
+        if isinstance(polls, list):
+            new_polls = [NewPoll.parse_obj(poll) for poll in polls]
+            created = crud.create_new_polls(database, new_polls, room)
+            return {"polls": [poll.dict(exclude={"votes"}) for poll in created]}
+
+        return error("type mismatch")
+    except ValidationError:
+        return error("type mismatch")
+    except Exception as err:  # pylint: disable=broad-exception-caught
+        return error(str(err))
+
+
 def delete_poll(database: Session, _user: User, args: Arguments) -> Package:
     "Remove a poll from the database and format a response."
     poll_id = args.get("poll_id")
+    room = args.get("room", DEFAULT_ROOM)
 
-    if isinstance(poll_id, int):
-        crud.delete_poll(database, poll_id)
+    if isinstance(poll_id, int) and isinstance(room, str):
+        if not crud.delete_poll(database, poll_id, room):
+            return error("not found")
+        tally.forget_poll(poll_id)
         return {"poll_id": poll_id}
 
     return error("type mismatch")
@@ -56,9 +89,11 @@ def delete_poll(database: Session, _user: User, args: Arguments) -> Package:
 def hide_poll(database: Session, _user: User, args: Arguments) -> Package:
     "Hide a poll from the database and format a response."
     poll_id = args.get("poll_id")
+    room = args.get("room", DEFAULT_ROOM)
 
-    if isinstance(poll_id, int):
-        crud.hide_poll(database, poll_id)
+    if isinstance(poll_id, int) and isinstance(room, str):
+        if not crud.hide_poll(database, poll_id, room):
+            return error("not found")
         return {"poll_id": poll_id}
 
     return error("type mismatch")
@@ -67,9 +102,11 @@ def hide_poll(database: Session, _user: User, args: Arguments) -> Package:
 def show_poll(database: Session, _user: User, args: Arguments) -> Package:
     "Show a poll from the database and format a response."
     poll_id = args.get("poll_id")
+    room = args.get("room", DEFAULT_ROOM)
 
-    if isinstance(poll_id, int):
-        crud.show_poll(database, poll_id)
+    if isinstance(poll_id, int) and isinstance(room, str):
+        if not crud.show_poll(database, poll_id, room):
+            return error("not found")
         return {"poll_id": poll_id}
 
     return error("type mismatch")
@@ -79,12 +116,30 @@ def vote(database: Session, user: User, args: Arguments) -> Package:
     "Add a vote to the database and format a response."
     poll = args.get("poll")
     option = args.get("option")
-    if isinstance(poll, int) and isinstance(option, int):
+    room = args.get("room", DEFAULT_ROOM)
+    if isinstance(poll, int) and isinstance(option, int) and isinstance(room, str):
         try:
-            crud.poll_vote(database, user.id, poll, option)
-            votes = crud.poll_votes(database, poll, option)
-            return {"poll": poll, "option": option, "count": len(votes)}
+            added = crud.poll_vote(database, user.id, poll, option, room)
+            if added is None:
+                return error("not found")
+            count = tally.poll_vote(poll, option, added)
+            if settings.broadcast_bus != "local":
+                # Other server processes record votes too, only the database knows all.
+                tally.recount(database, {(poll, option)}, set())
+                count = tally.poll_votes(poll, option)
+            return {"poll": poll, "option": option, "count": count}
         except Exception as err:  # pylint: disable=broad-exception-caught
             return error(f"Recording vote: {err}")
 
     return error("type mismatch")
+
+
+def vote_toggle(user: User, args: Arguments) -> PollToggle | Package:
+    "Check a vote on a poll for batched writing, or format an error response."
+    poll = args.get("poll")
+    option = args.get("option")
+    room = args.get("room", DEFAULT_ROOM)
+    if isinstance(poll, int) and isinstance(option, int) and isinstance(room, str):
+        return PollToggle(user.id, poll, option, room)
+
+    return error("type mismatch")
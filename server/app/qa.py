@@ -3,8 +3,12 @@
 from sqlalchemy.orm import Session
 
 from app import crud
+from app.batching import QuestionToggle
 from app.client import error, Package
+from app.config import settings
+from app.models import DEFAULT_ROOM
 from app.schemas import User
+from app.tally import tally
 
 Arguments = dict[str, str | int | list[str]]
 
@@ -12,9 +16,10 @@ Arguments = dict[str, str | int | list[str]]
 def create_new_discussion(database: Session, user: User, args: Arguments) -> Package:
     "Create a new Q&A."
     text = args.get("text")
+    room = args.get("room", DEFAULT_ROOM)
     try:
-        if isinstance(text, str):
-            discussion = crud.create_new_discussion(database, user, text)
+        if isinstance(text, str) and isinstance(room, str):
+            discussion = crud.create_new_discussion(database, user, text, room)
             return {
                 "id": discussion.id,
                 "text": discussion.text,
@@ -28,10 +33,26 @@ def create_new_discussion(database: Session, user: User, args: Arguments) -> Pac
 def vote(database: Session, user: User, args: Arguments) -> Package:
     "Vote on a question."
     question = args.get("qa")
-    if isinstance(question, int):
-        crud.qa_vote(database, user.id, question)
-        votes = crud.qa_votes(database, question)
-        return {"qa": question, "count": len(votes)}
+    room = args.get("room", DEFAULT_ROOM)
+    if isinstance(question, int) and isinstance(room, str):
+        added = crud.qa_vote(database, user.id, question, room)
+        if added is None:
+            return error("not found")
+        count = tally.qa_vote(question, added)
+        if settings.broadcast_bus != "local":
+            # Other server processes record votes too, only the database knows all.
+            tally.recount(database, set(), {question})
+            count = tally.qa_votes(question)
+        return {"qa": question, "count": count}
+    return error("type mismatch")
+
+
+def vote_toggle(user: User, args: Arguments) -> QuestionToggle | Package:
+    "Check a vote on a question for batched writing, or format an error response."
+    question = args.get("qa")
+    room = args.get("room", DEFAULT_ROOM)
+    if isinstance(question, int) and isinstance(room, str):
+        return QuestionToggle(user.id, question, room)
     return error("type mismatch")
 
 
@@ -39,9 +60,16 @@ def comment(database: Session, user: User, args: Arguments) -> Package:
     "Comment on a question."
     text = args.get("text")
     question = args.get("qa")
+    room = args.get("room", DEFAULT_ROOM)
     try:
-        if isinstance(text, str) and isinstance(question, int):
-            qa_comment = crud.qa_comment(database, user, text, question)
+        if (
+            isinstance(text, str)
+            and isinstance(question, int)
+            and isinstance(room, str)
+        ):
+            qa_comment = crud.qa_comment(database, user, text, question, room)
+            if qa_comment is None:
+                return error("not found")
             return {
                 "id": qa_comment.id,
                 "qa": qa_comment.question,
@@ -56,7 +84,10 @@ def comment(database: Session, user: User, args: Arguments) -> Package:
 def delete(database: Session, _user: User, args: Arguments) -> Package:
     "Delete a whole Q&A."
     question = args.get("qa")
-    if isinstance(question, int):
-        crud.qa_delete(database, question)
+    room = args.get("room", DEFAULT_ROOM)
+    if isinstance(question, int) and isinstance(room, str):
+        if not crud.qa_delete(database, question, room):
+            return error("not found")
+        tally.forget_question(question)
         return {"qa": question}
     return error("type mismatch")
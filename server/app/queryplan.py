@@ -0,0 +1,125 @@
+" Checking that the hot queries of the server are served by indexes "
+
+from collections.abc import Callable
+import re
+import sqlite3
+from typing import Any
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from app import crud
+from app.models import DEFAULT_ROOM, Base
+from app.schemas import NewPoll, User
+
+SOMEONE = User(id=1, first_name="Some", last_name="One", role="user", image=None)
+
+# Everything the server does per vote, per comment and per /state/ request,
+# on a database holding only poll 1 (options 1 and 2) and question 1.
+HOT_QUERIES: dict[str, Callable[[Session], Any]] = {
+    "poll summaries": lambda db: crud.poll_summaries(db, DEFAULT_ROOM),
+    "poll options": lambda db: crud.all_poll_options(db, DEFAULT_ROOM),
+    "poll vote": lambda db: crud.poll_vote(db, 1, 1, 1, DEFAULT_ROOM),
+    "poll vote toggles": lambda db: crud.toggle_poll_votes(
+        db, [(1, 1, 1, DEFAULT_ROOM), (2, 1, 2, DEFAULT_ROOM)]
+    ),
+    "poll vote totals": lambda db: crud.poll_vote_totals(db, {1, 2}),
+    "poll vote totals in room": lambda db: crud.poll_vote_totals(db, room=DEFAULT_ROOM),
+    "poll results": lambda db: crud.poll_results(db, DEFAULT_ROOM),
+    "poll results after": lambda db: crud.poll_results(db, DEFAULT_ROOM, (1, 1)),
+    "discussion summaries": lambda db: crud.discussion_summaries(db, DEFAULT_ROOM),
+    "comments": lambda db: crud.all_comments(db, DEFAULT_ROOM),
+    "comment": lambda db: crud.qa_comment(db, SOMEONE, "Comment", 1, DEFAULT_ROOM),
+    "qa vote": lambda db: crud.qa_vote(db, 1, 1, DEFAULT_ROOM),
+    "qa vote toggles": lambda db: crud.toggle_qa_votes(
+        db, [(1, 1, DEFAULT_ROOM), (2, 1, DEFAULT_ROOM)]
+    ),
+    "qa vote totals": lambda db: crud.qa_vote_totals(db, {1, 2}),
+    "qa vote totals in room": lambda db: crud.qa_vote_totals(db, room=DEFAULT_ROOM),
+    "question transcript": lambda db: crud.question_transcript(db, DEFAULT_ROOM),
+    "question transcript after": lambda db: crud.question_transcript(
+        db, DEFAULT_ROOM, (1, 1)
+    ),
+    "question transcript after uncommented": lambda db: crud.question_transcript(
+        db, DEFAULT_ROOM, (1, None)
+    ),
+}
+
+
+def full_scans(plan: list[str]) -> list[str]:
+    """
+    The steps of a query plan reading every row of a table, or every entry of
+    an index of a table, instead of searching for the rows it needs.
+    """
+    tables = "|".join(Base.metadata.tables)
+    scan = re.compile(rf"^SCAN ({tables})\b")
+    return [step for step in plan if scan.match(step)]
+
+
+def check(schema: list[str]) -> dict[str, list[tuple[str, list[str]]]]:
+    """
+    Run all hot queries against a database with the given schema (CREATE
+    statements), holding a single poll and question, and return the query
+    plans of the statements doing a full table scan, by query.
+    """
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    with engine.begin() as connection:
+        for statement in schema:
+            connection.exec_driver_sql(statement)
+    with Session(engine) as database:
+        crud.create_new_polls(
+            database, [NewPoll(title="Poll", description="", options=["A", "B"])]
+        )
+        crud.create_new_discussion(database, SOMEONE, "Question")
+
+    statements: list[tuple[str, Any]] = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def record(  # pylint: disable=too-many-arguments
+        _connection: Any,
+        _cursor: Any,
+        statement: str,
+        parameters: Any,
+        _context: Any,
+        executemany: bool,
+    ) -> None:
+        statements.append((statement, parameters[0] if executemany else parameters))
+
+    problems: dict[str, list[tuple[str, list[str]]]] = {}
+    for name, query in HOT_QUERIES.items():
+        statements.clear()
+        with Session(engine, expire_on_commit=False) as database:
+            query(database)
+
+        raw = engine.raw_connection()
+        try:
+            for statement, parameters in list(statements):
+                plan = [
+                    str(row[3])
+                    for row in raw.cursor().execute(
+                        f"EXPLAIN QUERY PLAN {statement}", parameters
+                    )
+                ]
+                if full_scans(plan):
+                    problems.setdefault(name, []).append((statement, plan))
+        finally:
+            raw.close()
+
+    return problems
+
+
+def schema_of(connection: sqlite3.Connection) -> list[str]:
+    "The CREATE statements of all tables and indexes of a database."
+    return [
+        sql
+        for (sql,) in connection.execute(
+            "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL "
+            "AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY CASE type WHEN 'table' THEN 0 ELSE 1 END"
+        )
+    ]
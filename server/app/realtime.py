@@ -7,9 +7,13 @@ from typing import Callable, Literal
 from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect
 from sqlalchemy.orm import Session
 
-from app import deps, polls, qa
+from app import bus, deps, polls, qa, state
 from app.authorization import AuthorizationError
-from app.client import ConnectionManager, Package, error, response
+from app.batching import NotFound, Toggle, VoteBatcher
+from app.client import Client, ConnectionManager, Message, Package, error, response
+from app.config import settings
+from app.counts import CountsTicker
+from app.database import ready, run_blocking
 from app.schemas import User
 
 
@@ -18,7 +22,15 @@ from app.schemas import User
 
 router = APIRouter()
 
-manager = ConnectionManager()
+
+def remote_change(room: str, _message: Message) -> None:
+    "Another server process changed something in a room: the cached state is out of date."
+    state.cache.invalidate(room)
+
+
+manager = ConnectionManager(
+    bus.connect(settings.broadcast_bus, settings.broadcast_bus_channel), remote_change
+)
 
 log = logging.getLogger(__name__)
 
@@ -29,6 +41,8 @@ Arguments = dict[str, str | int | list[str]]
 
 HandlerFn = Callable[[Session, User, Arguments], Package]
 
+ToggleFn = Callable[[User, Arguments], Toggle | Package]
+
 
 def pong_response(_database: Session, _user: User, _args: Arguments) -> Package:
     "Placeholder."
@@ -41,6 +55,7 @@ dispatch: dict[
 ] = {
     "ping": ("user", pong_response),
     "new_poll": ("admin", polls.create_new_poll),
+    "new_polls": ("admin", polls.create_new_polls),
     "delete_poll": ("admin", polls.delete_poll),
     "poll_hide": ("admin", polls.hide_poll),
     "poll_show": ("admin", polls.show_poll),
@@ -51,6 +66,55 @@ dispatch: dict[
     "qa_delete": ("admin", qa.delete),
 }
 
+# Votes which are written in batches (see `settings.vote_batching`)
+batched: dict[str, ToggleFn] = {
+    "poll_vote": polls.vote_toggle,
+    "qa_vote": qa.vote_toggle,
+}
+
+
+ticker = CountsTicker(manager.broadcast)
+
+
+async def publish_counts(messages: list[tuple[str, Message]]) -> None:
+    "Announce the new vote counts after a batch of votes has been written."
+    rooms: dict[str, list[Message]] = {}
+    for room, message in messages:
+        rooms.setdefault(room, []).append(message)
+
+    for room, room_messages in rooms.items():
+        if settings.counts_tick_rate > 0:
+            ticker.update(room, room_messages)
+        else:
+            for message in room_messages:
+                await manager.broadcast(room, message)
+        state.cache.invalidate(room)
+
+
+batcher = VoteBatcher(publish_counts, state.cache.invalidate)
+
+
+def arguments(client: Client, message: Message) -> Arguments:
+    "The arguments of a message: everything but its type, and the room of the client."
+    args = {key: value for (key, value) in message.items() if key != "msg"}
+    args["room"] = client.room
+    return args
+
+
+async def vote(client: Client, message: Message) -> None:
+    "Queue a vote to be written with the next batch. Only errors are sent back."
+    toggle = batched[str(message["msg"])](client.user, arguments(client, message))
+    if isinstance(toggle, dict):
+        client.send(toggle)
+        return
+
+    try:
+        await batcher.toggle(toggle)
+    except NotFound as err:
+        client.send(error(str(err)))
+    except Exception as err:  # pylint: disable=broad-exception-caught
+        client.send(error(f"Recording vote: {err}"))
+
 
 @router.websocket("/ws")
 async def realtime_comms(
@@ -63,6 +127,7 @@ async def realtime_comms(
     log.info("New websocket connection on /ws")
 
     try:
+        await ready.wait()
         client = await manager.connect(websocket)
         log.info("Connected client: %s", client.uid)
 
@@ -72,31 +137,35 @@ async def realtime_comms(
             log.info("Received (from: %s): %s", client.uid, message)
 
             if message["msg"] == "ping":
-                await websocket.send_json({"msg": "pong"})
+                client.send({"msg": "pong"})
             elif role == "admin" and client.role != "admin":
-                await websocket.send_json(error("Forbidden"))
+                client.send(error("Forbidden"))
+            elif settings.vote_batching and message["msg"] in batched:
+                await vote(client, message)
             else:
-                await manager.broadcast(
-                    response(
-                        message["msg"],
-                        handler(
-                            database,
-                            client.user,
-                            {
-                                key: value
-                                for (key, value) in message.items()
-                                if key != "msg"
-                            },
-                        ),
-                    )
+                # Handlers commit to the database: keep that off the event loop.
+                # Waiting for the result keeps each clients messages in order.
+                package = await run_blocking(
+                    handler,
+                    database,
+                    client.user,
+                    arguments(client, message),
                 )
+                if package.get("msg") == "error":
+                    client.send(package)
+                else:
+                    await manager.broadcast(
+                        client.room, response(message["msg"], package)
+                    )
+                # Failed handlers roll back changes that may have been read meanwhile.
+                state.cache.invalidate(client.room)
     except WebSocketDisconnect as reason:
         log.warning("WebSocketDisconnect: %s", str(reason))
         if client is not None:
             log.info("Disconnecting client %s", client.uid)
             await manager.disconnect(client)
 
-    except (JSONDecodeError, KeyError) as err:
+    except (JSONDecodeError, KeyError, ValueError) as err:
         log.error("Error: %s", err)
         await websocket.send_json(error(str(err)))
         await websocket.close()
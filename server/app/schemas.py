@@ -33,6 +33,11 @@ class AuthorizationCode(BaseModel):
     redirect: str
 
 
+# Rooms
+
+ROOM_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+
+
 # Polls
 
 
@@ -46,6 +51,14 @@ class Poll(BaseModel):
     votes: dict[int, int]
 
 
+class NewPoll(BaseModel):
+    "A poll to be created"
+    title: str
+    description: str
+    hidden: bool = False
+    options: list[str]
+
+
 class Comment(BaseModel):
     "A Q&A comment  on a discussion thread"
     id: int
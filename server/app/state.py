@@ -1,61 +1,168 @@
 " HTTP API for poll and discussion state "
 
-from itertools import groupby
+from collections import defaultdict
+from functools import partial
+from threading import Lock
+from typing import Optional
+from uuid import uuid4 as uuid
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Header, Query, Response, status
 from sqlalchemy.orm import Session
 
 from app import crud, deps
-from app import models as dbmdl
-from app.schemas import Comment, Discussion, Poll, State, User
+from app.database import run_committed
+from app.models import DEFAULT_ROOM
+from app.schemas import ROOM_PATTERN, Comment, Discussion, Poll, State, User
 
 router = APIRouter()
 
 
+def snapshot(database: Session, room: str) -> State:
+    """
+    Build the complete state of a room with a fixed number of queries,
+    however many polls, votes, questions and comments there are.
+    """
+    options: defaultdict[int, list[tuple[str, int]]] = defaultdict(list)
+    for poll, option, text in crud.all_poll_options(database, room):
+        options[poll].append((text, option))
+
+    votes: defaultdict[int, dict[int, int]] = defaultdict(dict)
+    for poll, option, count in crud.poll_vote_totals(database, room=room):
+        votes[poll][option] = count
+
+    qa_votes = dict(crud.qa_vote_totals(database, room=room))
+
+    comments: defaultdict[int, list[Comment]] = defaultdict(list)
+    for question, comment, text, first_name, last_name in crud.all_comments(
+        database, room
+    ):
+        comments[question].append(
+            Comment(id=comment, text=text, user=f"{first_name} {last_name}")
+        )
+
+    return State(
+        polls=[
+            Poll(
+                id=poll,
+                title=title,
+                description=description,
+                hidden=hidden,
+                options=options[poll],
+                votes=votes[poll],
+            )
+            for (poll, title, description, hidden) in crud.poll_summaries(
+                database, room
+            )
+        ],
+        qas=[
+            Discussion(
+                id=question,
+                text=text,
+                votes=qa_votes.get(question, 0),
+                user=f"{first_name} {last_name}",
+                comments=comments[question],
+            )
+            for (question, text, first_name, last_name) in crud.discussion_summaries(
+                database, room
+            )
+        ],
+    )
+
+
+def serialized(database: Session, room: str) -> bytes:
+    "The complete state of a room as JSON."
+    return snapshot(database, room).json(separators=(",", ":")).encode()
+
+
+class StateCache:
+    """
+    The serialized state of each room, rebuilt only after it has changed.
+    Every change bumps the version of the room, which is sent to clients as an ETag.
+    The epoch makes versions from a previous run of the server not match.
+    """
+
+    lock: Lock
+    epoch: str
+    versions: dict[str, int]
+    bodies: dict[str, tuple[int, bytes]]
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.epoch = uuid().hex[:8]
+        self.versions = {}
+        self.bodies = {}
+
+    def etag(self, room: str, version: int) -> str:
+        "The ETag header value for a version of the state of a room."
+        return f'"{self.epoch}-{room}-{version}"'
+
+    def current_etag(self, room: str) -> str:
+        "The ETag of the current state of a room."
+        with self.lock:
+            return self.etag(room, self.versions.get(room, 0))
+
+    def invalidate(self, room: str) -> None:
+        "Mark the state of a room as changed."
+        with self.lock:
+            self.versions[room] = self.versions.get(room, 0) + 1
+
+    def cached(self, room: str) -> Optional[tuple[str, bytes]]:
+        "The ETag and serialized current state of a room, if it is cached."
+        with self.lock:
+            version = self.versions.get(room, 0)
+            if (cached := self.bodies.get(room)) is not None and cached[0] == version:
+                return (self.etag(room, version), cached[1])
+        return None
+
+    def build(self, database: Session, room: str) -> tuple[str, bytes]:
+        "Build, cache and return the ETag and serialized current state of a room."
+        with self.lock:
+            version = self.versions.get(room, 0)
+        return self.store(room, version, serialized(database, room))
+
+    def store(self, room: str, version: int, body: bytes) -> tuple[str, bytes]:
+        "Cache the state of a room as of a version, and return it with its ETag."
+        with self.lock:
+            # Do not cache a state that was changed while it was being built.
+            if self.versions.get(room, 0) == version:
+                self.bodies[room] = (version, body)
+        return (self.etag(room, version), body)
+
+
+cache = StateCache()
+
+
+def matches(if_none_match: Optional[str], etag: str) -> bool:
+    "Does an If-None-Match header match the given ETag?"
+    if if_none_match is None:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in candidates or "*" in candidates
+
+
 @router.get("/", response_model=State)
-def get_state(
-    database: Session = Depends(deps.get_db), _user: User = Depends(deps.current_user)
-) -> State:
+async def get_state(
+    room: str = Query(default=DEFAULT_ROOM, regex=ROOM_PATTERN),
+    if_none_match: Optional[str] = Header(default=None),
+    database: Session = Depends(deps.get_read_db),
+    _user: User = Depends(deps.current_user),
+) -> Response:
     """
-    Current application state. Including:
+    Current state of a room. Including:
     - Polls
     - Q&A
+    Responds with 304 Not Modified when the client already has this version.
     """
+    headers = {"Cache-Control": "no-cache"}
 
-    def make_poll(poll: dbmdl.Poll) -> Poll:
-        "Create a Poll according to the schema from a ORM object."
-        options = [(opt.text, opt.id) for opt in poll.options]
-        votes = {
-            id: len(list(vals))
-            for (id, vals) in groupby(sorted(vote.option for vote in poll.votes))
-        }
-        return Poll(
-            id=poll.id,
-            title=poll.title,
-            description=poll.description,
-            hidden=poll.hidden,
-            options=options,
-            votes=votes,
-        )
-
-    def make_qa(question: dbmdl.Question) -> Discussion:
-        "Create a Discussion accoring to the schema from an ORM object."
-        return Discussion(
-            id=question.id,
-            text=question.text,
-            votes=len(question.votes),
-            user=f"{question.asker.first_name} {question.asker.last_name}",
-            comments=[
-                Comment(
-                    id=comment.id,
-                    text=comment.text,
-                    user=f"{comment.commenter.first_name} {comment.commenter.last_name}",
-                )
-                for comment in question.comments
-            ],
+    if matches(if_none_match, etag := cache.current_etag(room)):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers=headers | {"ETag": etag}
         )
 
-    return State(
-        polls=[make_poll(poll) for poll in crud.all_polls(database)],
-        qas=[make_qa(discussion) for discussion in crud.all_discussions(database)],
+    if (found := cache.cached(room)) is None:
+        found = await run_committed(partial(cache.build, room=room), database)
+    (etag, body) = found
+    return Response(
+        content=body, media_type="application/json", headers=headers | {"ETag": etag}
     )
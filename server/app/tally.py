@@ -0,0 +1,91 @@
+" In-memory vote counts for polls and Q&A "
+
+from threading import Lock
+
+from sqlalchemy.orm import Session
+
+from app import crud
+
+
+class VoteTally:
+    """
+    Vote counts per poll option and per question.
+    Warmed from the database once, then kept up to date by every vote toggle,
+    so recording a vote never has to count rows again.
+    """
+
+    lock: Lock
+    options: dict[tuple[int, int], int]
+    questions: dict[int, int]
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.options = {}
+        self.questions = {}
+
+    def warm(self, database: Session) -> None:
+        "(Re)load all vote counts from the database."
+        options = {
+            (poll, option): count
+            for (poll, option, count) in crud.poll_vote_totals(database)
+        }
+        questions = dict(crud.qa_vote_totals(database))
+        with self.lock:
+            self.options = options
+            self.questions = questions
+
+    def recount(
+        self, database: Session, options: set[tuple[int, int]], questions: set[int]
+    ) -> None:
+        "Reload the counts of some poll options and questions from the database."
+        option_counts = {
+            (poll, option): count
+            for (poll, option, count) in crud.poll_vote_totals(
+                database, {option for (_, option) in options}
+            )
+        }
+        question_counts = dict(crud.qa_vote_totals(database, questions))
+        with self.lock:
+            for key in options:
+                self.options[key] = option_counts.get(key, 0)
+            for question in questions:
+                self.questions[question] = question_counts.get(question, 0)
+
+    def poll_votes(self, poll: int, option: int) -> int:
+        "The number of votes on a poll option."
+        with self.lock:
+            return self.options.get((poll, option), 0)
+
+    def qa_votes(self, question: int) -> int:
+        "The number of votes on a question."
+        with self.lock:
+            return self.questions.get(question, 0)
+
+    def poll_vote(self, poll: int, option: int, added: bool) -> int:
+        "Record a toggled vote on a poll option and return the new count."
+        with self.lock:
+            count = self.options.get((poll, option), 0) + (1 if added else -1)
+            self.options[(poll, option)] = count
+            return count
+
+    def qa_vote(self, question: int, added: bool) -> int:
+        "Record a toggled vote on a question and return the new count."
+        with self.lock:
+            count = self.questions.get(question, 0) + (1 if added else -1)
+            self.questions[question] = count
+            return count
+
+    def forget_poll(self, poll: int) -> None:
+        "Drop the counts of a deleted poll."
+        with self.lock:
+            self.options = {
+                key: count for (key, count) in self.options.items() if key[0] != poll
+            }
+
+    def forget_question(self, question: int) -> None:
+        "Drop the count of a deleted question."
+        with self.lock:
+            self.questions.pop(question, None)
+
+
+tally = VoteTally()
@@ -0,0 +1,43 @@
+" In-memory directory of known users, to log in returning users without a query "
+
+from collections.abc import Iterable
+from threading import Lock
+from typing import Optional
+
+from app.models import User
+
+
+class UserCache:
+    """
+    All users by subject (their OpenID Connect identifier, which is also their id).
+    Warmed from the database once, then kept up to date as users are
+    provisioned, so a returning user logs in without being provisioned
+    again. Roles are changed by the admin command, in another process, so
+    they are read from the database on every login instead.
+    """
+
+    lock: Lock
+    users: dict[int, User]
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.users = {}
+
+    def warm(self, rows: Iterable[User]) -> None:
+        "(Re)load all users."
+        loaded = {user.id: user for user in rows}
+        with self.lock:
+            self.users = loaded
+
+    def get(self, subject: int) -> Optional[User]:
+        "A known user, if any."
+        with self.lock:
+            return self.users.get(subject)
+
+    def put(self, user: User) -> None:
+        "Remember a new or changed user."
+        with self.lock:
+            self.users[user.id] = user
+
+
+users = UserCache()
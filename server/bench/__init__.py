@@ -0,0 +1,7 @@
+" Benchmarks and load generators for the server, to be run by hand "
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    "The sample below which a fraction of all samples fall."
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
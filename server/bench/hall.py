@@ -0,0 +1,541 @@
+"""
+Load test the realtime path with a simulated lecture hall.
+
+Starts the server with hypercorn, seeded with a lecturer and `--trainees`
+trainees, and connects all of them to /ws through the real handshake (ready,
+auth, bearer) with locally minted bearer tokens. Then plays a scenario: in
+every round the lecturer opens a poll and, within `window` seconds, a share of
+the trainees vote on it, ask questions, vote on and comment on the questions.
+
+Meanwhile the lecturer regularly comments "probe <n>" on a Q&A of its own,
+which is broadcast to everybody. The time from sending a probe to each
+attendee receiving it is the broadcast latency; the time from its first to
+each receipt is the fan-out. Also reports messages per second, and the CPU
+time used by the server processes and by this load generator: when the load
+generator uses a whole core, it measures itself rather than the server.
+
+Clients are built on wsproto, which hypercorn depends on already.
+Server settings can be changed through the environment, as usual.
+
+Run with: python -m bench.hall --trainees 200 --scenario lecture
+"""
+
+import argparse
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+import json
+import os
+import random
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, NamedTuple, Optional
+
+from sqlalchemy import create_engine, insert
+from wsproto import ConnectionType, WSConnection
+from wsproto.connection import ConnectionState
+from wsproto.events import (
+    CloseConnection,
+    Ping,
+    RejectConnection,
+    Request,
+    TextMessage,
+)
+
+from app.models import DEFAULT_ROOM, Base, User
+from bench import percentile
+
+Message = dict[str, Any]
+
+
+class Scenario(NamedTuple):
+    """
+    What happens in a session: `rounds` rounds of `window` seconds. A poll
+    opens at the start of every round (when anybody votes on polls), then the
+    given shares of the trainees vote on it, ask a question, vote on a
+    question or comment on one, at random times within the window.
+    """
+
+    rounds: int
+    window: float
+    vote_share: float
+    question_share: float
+    question_vote_share: float
+    comment_share: float
+
+
+SCENARIOS = {
+    # A poll opens, 80% of the room votes within 5 seconds.
+    "poll": Scenario(1, 5.0, 0.8, 0.0, 0.0, 0.0),
+    # Questions are asked, voted on and discussed.
+    "qa": Scenario(1, 10.0, 0.0, 0.1, 0.5, 0.1),
+    # Polls one after another, with questions in between.
+    "lecture": Scenario(5, 5.0, 0.8, 0.05, 0.3, 0.05),
+}
+
+
+class Stats:  # pylint: disable=too-few-public-methods
+    "Everything counted and timed during a run."
+
+    sent: int
+    received: int
+    errors: list[str]
+    probes: dict[int, float]
+    receipts: dict[int, list[float]]
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        "Start counting afresh."
+        self.sent = 0
+        self.received = 0
+        self.errors = []
+        self.probes = {}
+        self.receipts = {}
+
+
+class Connection:
+    "A websocket client connection: wsproto on top of asyncio streams."
+
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    websocket: WSConnection
+    messages: deque[Message]
+    text: list[str]
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.websocket = WSConnection(ConnectionType.CLIENT)
+        self.messages = deque()
+        self.text = []
+
+    @classmethod
+    async def open(cls, host: str, port: int, path: str) -> "Connection":
+        "Connect and perform the websocket opening handshake."
+        connection = cls(*await asyncio.open_connection(host, port))
+        connection.writer.write(
+            connection.websocket.send(Request(host=f"{host}:{port}", target=path))
+        )
+        while connection.websocket.state != ConnectionState.OPEN:
+            await connection.pump()
+        return connection
+
+    async def pump(self) -> None:
+        "Read from the socket and handle the websocket events it brings."
+        data = await self.reader.read(65536)
+        if not data:
+            raise ConnectionError("Connection closed")
+        self.websocket.receive_data(data)
+        for event in self.websocket.events():
+            if isinstance(event, TextMessage):
+                self.text.append(event.data)
+                if event.message_finished:
+                    self.messages.append(json.loads("".join(self.text)))
+                    self.text.clear()
+            elif isinstance(event, Ping):
+                self.writer.write(self.websocket.send(event.response()))
+            elif isinstance(event, CloseConnection):
+                self.writer.write(self.websocket.send(event.response()))
+                raise ConnectionError(f"Closed by the server: {event.code}")
+            elif isinstance(event, RejectConnection):
+                raise ConnectionError(f"Rejected by the server: {event.status_code}")
+
+    async def receive(self) -> Message:
+        "The next message from the server."
+        while not self.messages:
+            await self.pump()
+        return self.messages.popleft()
+
+    async def send(self, message: Message) -> None:
+        "Send a message to the server."
+        self.writer.write(self.websocket.send(TextMessage(json.dumps(message))))
+        await self.writer.drain()
+
+    async def close(self) -> None:
+        "Close the connection, without waiting for the server to agree."
+        if self.websocket.state == ConnectionState.OPEN:
+            self.writer.write(self.websocket.send(CloseConnection(code=1000)))
+        self.writer.close()
+
+
+class Attendee:
+    "A simulated attendee: a connection, what it sends and what it receives."
+
+    user: int
+    stats: Stats
+    connection: Optional[Connection]
+    listening: Optional["asyncio.Task[None]"]
+    expected: dict[str, "asyncio.Future[Message]"]
+    questions: list[int]
+
+    def __init__(self, user: int, stats: Stats):
+        self.user = user
+        self.stats = stats
+        self.connection = None
+        self.listening = None
+        self.expected = {}
+        self.questions = []
+
+    async def join(self, host: str, port: int, room: str, token: str) -> None:
+        "Connect to the server and log in."
+        self.connection = await Connection.open(host, port, "/ws")
+        await self.connection.send({"msg": "ready", "room": room})
+        if (message := await self.connection.receive())["msg"] != "auth":
+            raise ConnectionError(f"Expected an auth request, got {message}")
+        await self.connection.send({"bearer": token})
+        self.listening = asyncio.create_task(self.listen())
+
+    async def send(self, message: Message) -> None:
+        "Send a message, counting it."
+        assert self.connection is not None
+        self.stats.sent += 1
+        await self.connection.send(message)
+
+    def expect(self, msg: str) -> "asyncio.Future[Message]":
+        "The next message of a type."
+        self.expected[msg] = asyncio.get_running_loop().create_future()
+        return self.expected[msg]
+
+    async def listen(self) -> None:
+        "Receive messages until the connection closes."
+        assert self.connection is not None
+        try:
+            while True:
+                message = await self.connection.receive()
+                now = time.perf_counter()
+                self.stats.received += 1
+
+                msg = message["msg"]
+                if msg == "error":
+                    self.stats.errors.append(message["error"])
+                elif msg == "new_qa":
+                    self.questions.append(message["id"])
+                elif msg == "qa_comment" and message["text"].startswith("probe "):
+                    number = int(message["text"].removeprefix("probe "))
+                    self.stats.receipts.setdefault(number, []).append(now)
+                if (expected := self.expected.pop(msg, None)) is not None:
+                    expected.set_result(message)
+        except (ConnectionError, OSError) as err:
+            self.stats.errors.append(f"user {self.user}: {err}")
+
+    async def leave(self) -> None:
+        "Disconnect."
+        if self.listening is not None:
+            self.listening.cancel()
+        if self.connection is not None:
+            await self.connection.close()
+
+
+def cpu_seconds(pid: int) -> float:
+    "The CPU time used so far by a process and all its descendants, from /proc."
+    ticks = os.sysconf("SC_CLK_TCK")
+    children: dict[int, list[int]] = {}
+    used: dict[int, float] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", encoding="utf-8") as file:
+                stat = file.read()
+        except OSError:
+            continue
+        # The fields after the command name, starting with the state.
+        fields = stat[stat.rindex(")") + 2 :].split()
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        used[int(entry)] = (int(fields[11]) + int(fields[12])) / ticks
+
+    total = 0.0
+    pending = [pid]
+    while pending:
+        process = pending.pop()
+        total += used.get(process, 0.0)
+        pending.extend(children.get(process, []))
+    return total
+
+
+def seed(uri: str, trainees: int) -> None:
+    "Create the database with the lecturer (user 1, an admin) and the trainees."
+    engine = create_engine(uri)
+    Base.metadata.create_all(engine)
+    created = datetime.now(tz=timezone.utc)
+    with engine.begin() as connection:
+        connection.execute(
+            insert(User),
+            [
+                {
+                    "id": uid,
+                    "created": created,
+                    "first_name": "Lecturer" if uid == 1 else "Trainee",
+                    "last_name": str(uid),
+                    "role": "admin" if uid == 1 else "user",
+                }
+                for uid in range(1, trainees + 2)
+            ],
+        )
+    engine.dispose()
+
+
+async def serve(
+    args: argparse.Namespace, env: dict[str, str]
+) -> subprocess.Popen[bytes]:
+    "Start the server, and wait until it accepts connections."
+    with open(args.server_log, "ab") as log:
+        server = subprocess.Popen(  # pylint: disable=consider-using-with
+            [
+                sys.executable,
+                "-m",
+                "hypercorn",
+                "app.main:app",
+                "--bind",
+                f"{args.host}:{args.port}",
+            ],
+            env=env,
+            stdout=log,
+            stderr=log,
+            # Its worker processes are stopped together with it.
+            start_new_session=True,
+        )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline and server.poll() is None:
+        try:
+            (_, writer) = await asyncio.open_connection(args.host, args.port)
+            writer.close()
+            return server
+        except OSError:
+            await asyncio.sleep(0.1)
+    os.killpg(server.pid, signal.SIGKILL)
+    raise RuntimeError("The server did not start")
+
+
+async def probe(lecturer: Attendee, question: int, interval: float) -> None:
+    "Comment on the probe Q&A every `interval` seconds, until cancelled."
+    stats = lecturer.stats
+    while True:
+        number = len(stats.probes)
+        stats.probes[number] = time.perf_counter()
+        await lecturer.send(
+            {"msg": "qa_comment", "qa": question, "text": f"probe {number}"}
+        )
+        await asyncio.sleep(interval)
+
+
+async def play(  # pylint: disable=too-many-arguments,too-many-locals
+    scenario: Scenario,
+    lecturer: Attendee,
+    trainees: list[Attendee],
+    probe_question: int,
+    workload: random.Random,
+    settle: float,
+) -> None:
+    "Play all rounds of a scenario."
+
+    async def later(delay: float, trainee: Attendee, message: Message) -> None:
+        await asyncio.sleep(delay)
+        await trainee.send(message)
+
+    async def about_a_question(delay: float, trainee: Attendee, msg: str) -> None:
+        await asyncio.sleep(delay)
+        # Only the questions asked so far can be voted or commented on.
+        questions = [q for q in lecturer.questions if q != probe_question]
+        if questions:
+            message: Message = {"msg": msg, "qa": workload.choice(questions)}
+            if msg == "qa_comment":
+                message["text"] = "I was wondering about that too"
+            await trainee.send(message)
+
+    for round_ in range(scenario.rounds):
+        actions = []
+        if scenario.vote_share > 0:
+            opened = lecturer.expect("new_poll")
+            await lecturer.send(
+                {
+                    "msg": "new_poll",
+                    "title": f"Poll {round_ + 1}",
+                    "description": "",
+                    "hidden": False,
+                    "options": ["A", "B", "C", "D"],
+                }
+            )
+            poll = await opened
+            for trainee in trainees:
+                if workload.random() < scenario.vote_share:
+                    (_, option) = workload.choice(poll["options"])
+                    vote = {"msg": "poll_vote", "poll": poll["id"], "option": option}
+                    delay = workload.uniform(0, scenario.window)
+                    actions.append(later(delay, trainee, vote))
+
+        for trainee in trainees:
+            if workload.random() < scenario.question_share:
+                question = {"msg": "new_qa", "text": f"Question from {trainee.user}"}
+                delay = workload.uniform(0, scenario.window)
+                actions.append(later(delay, trainee, question))
+            for share, msg in (
+                (scenario.question_vote_share, "qa_vote"),
+                (scenario.comment_share, "qa_comment"),
+            ):
+                if workload.random() < share:
+                    delay = workload.uniform(0, scenario.window)
+                    actions.append(about_a_question(delay, trainee, msg))
+
+        await asyncio.gather(*actions, asyncio.sleep(scenario.window))
+    await asyncio.sleep(settle)
+
+
+def report(  # pylint: disable=too-many-arguments
+    stats: Stats, attendees: int, elapsed: float, server_cpu: float, own_cpu: float
+) -> None:
+    "Print the results of a run."
+    latencies = [
+        receipt - stats.probes[probe]
+        for (probe, receipts) in stats.receipts.items()
+        for receipt in receipts
+    ]
+    fan_out = [
+        receipt - min(receipts)
+        for receipts in stats.receipts.values()
+        for receipt in receipts
+    ]
+    print(f"duration: {elapsed:.1f}s")
+    print(
+        f"messages: {stats.sent} sent ({stats.sent / elapsed:.0f}/s), "
+        f"{stats.received} received ({stats.received / elapsed:.0f}/s)"
+    )
+    if latencies:
+        print(
+            f"broadcast latency: p50 {percentile(latencies, 0.5) * 1000:.1f}ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms "
+            f"({len(stats.probes)} probes, "
+            f"{len(latencies)} of {len(stats.probes) * attendees} receipts)"
+        )
+        print(
+            f"fan-out: p50 {percentile(fan_out, 0.5) * 1000:.1f}ms, "
+            f"p99 {percentile(fan_out, 0.99) * 1000:.1f}ms"
+        )
+    print(
+        f"server CPU: {server_cpu:.2f}s ({server_cpu / elapsed:.0%} of a core), "
+        f"load generator CPU: {own_cpu:.2f}s ({own_cpu / elapsed:.0%} of a core)"
+    )
+    if stats.errors:
+        print(f"errors: {len(stats.errors)}, first: {stats.errors[0]}")
+
+
+async def run(args: argparse.Namespace) -> None:  # pylint: disable=too-many-locals
+    "Start the server, fill the lecture hall and play the scenario."
+    overrides = {
+        field: value
+        for field in Scenario._fields
+        if (value := getattr(args, field)) is not None
+    }
+    scenario = SCENARIOS[args.scenario]._replace(**overrides)
+
+    # Tokens are minted here and verified by the server: they share the secret.
+    directory = tempfile.mkdtemp()
+    env = os.environ | {
+        "API_SECRET": os.environ.get("API_SECRET", secrets.token_urlsafe(32)),
+        "BACKUP_DATABASE_URI": f"sqlite:///{directory}/hall.sqlite",
+        "BACKUP_INTERVAL": "0",
+    }
+    os.environ.update(env)
+    from app.auth import create_access_token  # pylint: disable=import-outside-toplevel
+
+    seed(env["BACKUP_DATABASE_URI"], args.trainees)
+    server = await serve(args, env)
+    try:
+        stats = Stats()
+        (lecturer, *trainees) = attendees = [
+            Attendee(uid, stats) for uid in range(1, args.trainees + 2)
+        ]
+        connecting = asyncio.Semaphore(args.connect_concurrency)
+
+        async def join(attendee: Attendee) -> None:
+            token = create_access_token(
+                {
+                    "id": attendee.user,
+                    "first_name": "Lecturer" if attendee is lecturer else "Trainee",
+                    "last_name": str(attendee.user),
+                    "iat": int(time.time()),
+                    "role": "admin" if attendee is lecturer else "user",
+                }
+            )
+            async with connecting:
+                await attendee.join(args.host, args.port, args.room, token)
+
+        await asyncio.gather(*(join(attendee) for attendee in attendees))
+        asked = lecturer.expect("new_qa")
+        await lecturer.send({"msg": "new_qa", "text": "Probe"})
+        probe_question = (await asked)["id"]
+        await asyncio.sleep(args.settle)
+        print(f"{len(attendees)} attendees connected, playing {scenario}")
+
+        stats.reset()
+        (start, server_start, own_start) = (
+            time.perf_counter(),
+            cpu_seconds(server.pid),
+            time.process_time(),
+        )
+        probing = asyncio.create_task(
+            probe(lecturer, probe_question, args.probe_interval)
+        )
+        await play(
+            scenario,
+            lecturer,
+            trainees,
+            probe_question,
+            random.Random(args.seed),
+            args.settle,
+        )
+        probing.cancel()
+        report(
+            stats,
+            len(attendees),
+            time.perf_counter() - start,
+            cpu_seconds(server.pid) - server_start,
+            time.process_time() - own_start,
+        )
+
+        await asyncio.gather(*(attendee.leave() for attendee in attendees))
+    finally:
+        server.send_signal(signal.SIGINT)
+        # Saving the database on shutdown is of no use here: do not wait long.
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            os.killpg(server.pid, signal.SIGKILL)
+        shutil.rmtree(directory)
+
+
+def main() -> None:
+    "Parse arguments and run the load test."
+    parser = argparse.ArgumentParser(description="Simulate a lecture hall")
+    parser.add_argument("--trainees", type=int, default=200)
+    parser.add_argument("--scenario", choices=SCENARIOS, default="lecture")
+    parser.add_argument("--rounds", type=int, help="Override the scenario")
+    parser.add_argument("--window", type=float, help="Override the scenario")
+    parser.add_argument("--vote-share", type=float, help="Override the scenario")
+    parser.add_argument("--question-share", type=float, help="Override the scenario")
+    parser.add_argument(
+        "--question-vote-share", type=float, help="Override the scenario"
+    )
+    parser.add_argument("--comment-share", type=float, help="Override the scenario")
+    parser.add_argument("--probe-interval", type=float, default=0.25)
+    parser.add_argument("--settle", type=float, default=1.0)
+    parser.add_argument("--connect-concurrency", type=int, default=50)
+    parser.add_argument("--room", default=DEFAULT_ROOM)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--server-log", default=os.devnull, help="Where the server logs to"
+    )
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
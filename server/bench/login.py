@@ -0,0 +1,109 @@
+"""
+Benchmark the login path (POST /auth/token) against the mock OpenID Connect
+provider in bench/oidc.py, without network access.
+
+Simulates a room full of people logging in at the start of a session:
+`--users` logins, `--concurrency` at a time. The first round logs in new
+users, later `--rounds` log the same users in again. Reports login latencies
+per round and how many requests reached the provider.
+
+Run with: python -m bench.login --users 300 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+import uvicorn
+
+from bench import percentile
+from bench.oidc import create_app
+
+
+async def run(args: argparse.Namespace) -> None:  # pylint: disable=too-many-locals
+    "Start the mock provider and the server, and log everybody in."
+    issuer = f"http://127.0.0.1:{args.port}"
+    provider = uvicorn.Server(
+        uvicorn.Config(
+            create_app(issuer, args.max_age, args.latency),
+            port=args.port,
+            log_level="warning",
+        )
+    )
+    serving = asyncio.create_task(provider.serve())
+    while not provider.started:
+        await asyncio.sleep(0.01)
+
+    # The server reads its settings on import.
+    backup = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ["OIDC_ISSUER"] = issuer
+    os.environ["BACKUP_DATABASE_URI"] = f"sqlite:///{backup}"
+    os.environ["BACKUP_INTERVAL"] = "0"
+    # pylint: disable=import-outside-toplevel
+    from sqlalchemy import create_engine
+
+    from app import metrics
+    from app.main import app
+    from app.models import Base
+
+    # Restored into the in-memory database on startup.
+    Base.metadata.create_all(create_engine(f"sqlite:///{backup}"))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(app=app, base_url="http://buzz") as client:
+
+            async def login(user: int, latencies: list[float]) -> None:
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.post(
+                        "/auth/token",
+                        json={"code": str(user), "redirect": "http://localhost"},
+                    )
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - start)
+
+            for round_ in range(1, args.rounds + 1):
+                latencies: list[float] = []
+                start = time.perf_counter()
+                await asyncio.gather(
+                    *(login(user, latencies) for user in range(1, args.users + 1))
+                )
+                elapsed = time.perf_counter() - start
+
+                print(
+                    f"round {round_}: {args.users} logins in {elapsed:.2f}s "
+                    f"({args.users / elapsed:.0f}/s), "
+                    f"latency mean {statistics.mean(latencies) * 1000:.1f}ms, "
+                    f"p50 {percentile(latencies, 0.5) * 1000:.1f}ms, "
+                    f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms"
+                )
+
+        async with httpx.AsyncClient(base_url=issuer) as client:
+            requests = (await client.get("/stats")).json()
+        print(f"provider requests: {requests}")
+        print(f"server metrics: {metrics.snapshot()}")
+
+    provider.should_exit = True
+    await serving
+
+
+def main() -> None:
+    "Parse arguments and run the benchmark."
+    parser = argparse.ArgumentParser(description="Benchmark logging in")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--max-age", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.02)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+A mock OpenID Connect provider, standing in for VIB Services,
+to exercise and benchmark the login path offline.
+
+Any authorization code is accepted: a numeric code becomes the subject of the
+id token, so the same code logs in the same user.
+
+Run with: python -m bench.oidc --port 8001
+and point the server at it with OIDC_ISSUER=http://localhost:8001
+"""
+
+import argparse
+import asyncio
+import hashlib
+import time
+from urllib.parse import parse_qs
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from jose import jwk, jwt
+from jose.utils import calculate_at_hash
+
+KEY_ID = "bench"
+
+
+def signing_key() -> str:
+    "A fresh RSA private key, in PEM format."
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+
+
+def subject(code: str) -> int:
+    "The user an authorization code logs in."
+    if code.isdigit():
+        return int(code)
+    return int.from_bytes(hashlib.sha256(code.encode()).digest()[:4], "big")
+
+
+def create_app(issuer: str, max_age: int = 300, latency: float = 0.0) -> FastAPI:
+    """
+    The mock provider. JWKS responses may be cached for `max_age` seconds,
+    every response is delayed by `latency` seconds to mimic a remote server.
+    """
+    app = FastAPI()
+    # Constructed once: parsing the PEM key for every token is slow.
+    private_key = jwk.construct(signing_key(), "RS256")
+    public_key = private_key.public_key().to_dict()
+    stats = {"token": 0, "jwks": 0, "userinfo": 0}
+
+    @app.post("/connect/token")
+    async def token(request: Request) -> dict[str, str]:
+        # Parsed by hand: FastAPI needs python-multipart for Form() parameters.
+        form = parse_qs((await request.body()).decode())
+        (code, client_id) = (form["code"][0], form["client_id"][0])
+        stats["token"] += 1
+        await asyncio.sleep(latency)
+        access_token = f"access-{subject(code)}"
+        now = int(time.time())
+        claims = {
+            "iss": issuer,
+            "sub": str(subject(code)),
+            "aud": client_id,
+            "iat": now,
+            "exp": now + 3600,
+            "at_hash": calculate_at_hash(access_token, hashlib.sha256),
+        }
+        id_token = jwt.encode(claims, private_key, "RS256", headers={"kid": KEY_ID})
+        return {
+            "id_token": id_token,
+            "access_token": access_token,
+            "token_type": "Bearer",
+        }
+
+    @app.get("/.well-known/openid-configuration/jwks")
+    async def jwks(response: Response) -> dict[str, list[dict[str, str]]]:
+        stats["jwks"] += 1
+        await asyncio.sleep(latency)
+        response.headers["Cache-Control"] = f"public, max-age={max_age}"
+        return {"keys": [public_key | {"kid": KEY_ID, "use": "sig"}]}
+
+    @app.get("/connect/userinfo")
+    async def userinfo(authorization: str = Header()) -> dict[str, str]:
+        stats["userinfo"] += 1
+        await asyncio.sleep(latency)
+        if not authorization.startswith("Bearer access-"):
+            raise HTTPException(status_code=401)
+        user = authorization.removeprefix("Bearer access-")
+        return {"sub": user, "name": "User", "family_name": user}
+
+    @app.get("/stats")
+    async def get_stats() -> dict[str, int]:
+        return stats
+
+    return app
+
+
+def main() -> None:
+    "Run the mock provider."
+    import uvicorn  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(description="Mock OpenID Connect provider")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--max-age", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    issuer = f"http://{args.host}:{args.port}"
+    uvicorn.run(
+        create_app(issuer, args.max_age, args.latency),
+        host=args.host,
+        port=args.port,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    main()
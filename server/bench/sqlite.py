@@ -0,0 +1,165 @@
+"""
+Benchmark SQLite engine profiles (the sqlite_* settings) on the vote workload.
+
+Every profile gets a fresh database with the same polls and Q&As, and then
+the same sequence of vote batches, as written by the vote batcher: a batch of
+`--batch` poll vote toggles and a batch of Q&A vote toggles per round, each in
+its own transaction, and a /state/ snapshot every `--state-every` rounds.
+Reports toggles per second and batch and snapshot latencies per profile.
+
+Run with: python -m bench.sqlite --rounds 500 --batch 20
+"""
+
+import argparse
+from datetime import datetime, timezone
+import random
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+from app import crud, models, state
+from app.config import Settings, settings
+from app.database import tune
+from app.models import DEFAULT_ROOM, Base
+from app.schemas import NewPoll, User
+from bench import percentile
+
+# SQLite's own defaults, and Python's default statement cache.
+DEFAULTS = settings.copy(
+    update={
+        "sqlite_journal_mode": "DELETE",
+        "sqlite_synchronous": "FULL",
+        "sqlite_mmap_size": 0,
+        "sqlite_cache_size": -2000,
+        "sqlite_temp_store": "DEFAULT",
+        "sqlite_cached_statements": 128,
+    }
+)
+
+PROFILES = {
+    "default": DEFAULTS,
+    "wal": DEFAULTS.copy(update={"sqlite_journal_mode": "WAL"}),
+    "wal-normal": DEFAULTS.copy(
+        update={"sqlite_journal_mode": "WAL", "sqlite_synchronous": "NORMAL"}
+    ),
+    "configured": settings,
+}
+
+
+def seed(database: Session, args: argparse.Namespace) -> list[int]:
+    "Create the users, polls and Q&As, returning the Q&As."
+    created = datetime.now(tz=timezone.utc)
+    database.execute(
+        insert(models.User),
+        [
+            {"id": uid, "created": created, "first_name": "User", "role": "user"}
+            for uid in range(1, args.users + 1)
+        ],
+    )
+    database.commit()
+
+    crud.create_new_polls(
+        database,
+        [
+            NewPoll(title=f"Poll {n}", description="", options=["A", "B", "C", "D"])
+            for n in range(args.polls)
+        ],
+    )
+    asker = User(id=1, first_name="User", last_name="1", role="user", image=None)
+    return [
+        crud.create_new_discussion(database, asker, f"Question {n}").id
+        for n in range(args.questions)
+    ]
+
+
+def run(  # pylint: disable=too-many-locals
+    name: str, profile: Settings, args: argparse.Namespace
+) -> None:
+    "Run the workload against a fresh database with an engine profile."
+    directory = tempfile.mkdtemp()
+    uri = "sqlite://" if args.memory else f"sqlite:///{directory}/bench.sqlite"
+    engine = tune(
+        create_engine(
+            uri,
+            future=True,
+            connect_args={"cached_statements": profile.sqlite_cached_statements},
+        ),
+        profile,
+    )
+    Base.metadata.create_all(engine)
+
+    with Session(engine, expire_on_commit=False) as database:
+        questions = seed(database, args)
+        polls = {
+            option: poll
+            for (poll, option, _) in crud.all_poll_options(database, DEFAULT_ROOM)
+        }
+        options = list(polls)
+        workload = random.Random(args.seed)
+
+        batches: list[float] = []
+        snapshots: list[float] = []
+        start = time.perf_counter()
+        for round_ in range(args.rounds):
+            poll_toggles = [
+                (uid, polls[option], option, DEFAULT_ROOM)
+                for (uid, option) in (
+                    (workload.randint(1, args.users), workload.choice(options))
+                    for _ in range(args.batch)
+                )
+            ]
+            qa_toggles = [
+                (
+                    workload.randint(1, args.users),
+                    workload.choice(questions),
+                    DEFAULT_ROOM,
+                )
+                for _ in range(args.batch)
+            ]
+
+            batch_start = time.perf_counter()
+            crud.toggle_poll_votes(database, poll_toggles)
+            crud.toggle_qa_votes(database, qa_toggles)
+            batches.append((time.perf_counter() - batch_start) / 2)
+
+            if round_ % args.state_every == 0:
+                snapshot_start = time.perf_counter()
+                state.snapshot(database, DEFAULT_ROOM)
+                snapshots.append(time.perf_counter() - snapshot_start)
+        elapsed = time.perf_counter() - start
+
+    engine.dispose()
+    toggles = 2 * args.rounds * args.batch
+    print(
+        f"{name:>10}: {toggles} toggles in {elapsed:.2f}s "
+        f"({toggles / elapsed:.0f}/s), "
+        f"batch p50 {percentile(batches, 0.5) * 1000:.2f}ms "
+        f"p99 {percentile(batches, 0.99) * 1000:.2f}ms, "
+        f"state p50 {percentile(snapshots, 0.5) * 1000:.2f}ms"
+    )
+    shutil.rmtree(directory)
+
+
+def main() -> None:
+    "Parse arguments and run the benchmark for every profile."
+    parser = argparse.ArgumentParser(description="Benchmark SQLite engine profiles")
+    parser.add_argument("--profile", choices=PROFILES, action="append")
+    parser.add_argument("--memory", action="store_true", help="In-memory database")
+    parser.add_argument("--rounds", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=20)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--polls", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--state-every", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for name in args.profile or PROFILES:
+        run(name, PROFILES[name], args)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ from alembic import context
 from app.config import settings
 
 # from app.database import engine
+from app.database import tune
 from app.models import Base
 
 # this is the Alembic Config object, which provides
@@ -61,7 +62,14 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
-    engine = create_engine(settings.backup_database_uri, future=True, echo=False)
+    engine = tune(
+        create_engine(
+            settings.backup_database_uri,
+            future=True,
+            echo=False,
+            connect_args={"cached_statements": settings.sqlite_cached_statements},
+        )
+    )
     with engine.connect() as connection:
         context.configure(
             connection=connection, target_metadata=target_metadata, render_as_batch=True
@@ -0,0 +1,36 @@
+"""Scope polls and questions to a room
+
+Revision ID: c3a1f0d9e2b4
+Revises: 8931fb4f5fc7
+Create Date: 2026-10-18 10:12:40.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c3a1f0d9e2b4"
+down_revision = "8931fb4f5fc7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("polls", schema=None) as batch_op:
+        batch_op.add_column(
+            sa.Column("room", sa.String(), nullable=False, server_default="default")
+        )
+
+    with op.batch_alter_table("questions", schema=None) as batch_op:
+        batch_op.add_column(
+            sa.Column("room", sa.String(), nullable=False, server_default="default")
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("questions", schema=None) as batch_op:
+        batch_op.drop_column("room")
+
+    with op.batch_alter_table("polls", schema=None) as batch_op:
+        batch_op.drop_column("room")
@@ -0,0 +1,43 @@
+"""Add indexes for the hot queries
+
+Revision ID: d7e4b2a9f1c0
+Revises: c3a1f0d9e2b4
+Create Date: 2026-10-18 14:03:27.512904
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "d7e4b2a9f1c0"
+down_revision = "c3a1f0d9e2b4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_polls_room_created", "polls", ["room", "created"])
+    op.create_index("ix_poll_options_poll", "poll_options", ["poll"])
+    op.create_index("ix_poll_votes_poll_option", "poll_votes", ["poll", "option"])
+    op.create_index("ix_poll_votes_user_option", "poll_votes", ["user", "option"])
+    op.create_index("ix_questions_room_created", "questions", ["room", "created"])
+    op.create_index(
+        "ix_question_comments_question_created",
+        "question_comments",
+        ["question", "created"],
+    )
+    op.create_index(
+        "ix_question_votes_user_question", "question_votes", ["user", "question"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_question_votes_user_question", table_name="question_votes")
+    op.drop_index(
+        "ix_question_comments_question_created", table_name="question_comments"
+    )
+    op.drop_index("ix_questions_room_created", table_name="questions")
+    op.drop_index("ix_poll_votes_user_option", table_name="poll_votes")
+    op.drop_index("ix_poll_votes_poll_option", table_name="poll_votes")
+    op.drop_index("ix_poll_options_poll", table_name="poll_options")
+    op.drop_index("ix_polls_room_created", table_name="polls")
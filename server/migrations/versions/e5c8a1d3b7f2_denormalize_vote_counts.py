@@ -0,0 +1,94 @@
+"""Denormalize vote counts
+
+Revision ID: e5c8a1d3b7f2
+Revises: d7e4b2a9f1c0
+Create Date: 2026-10-18 15:21:09.734216
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e5c8a1d3b7f2"
+down_revision = "d7e4b2a9f1c0"
+branch_labels = None
+depends_on = None
+
+TRIGGERS = {
+    "poll_votes_count_insert": """
+        CREATE TRIGGER poll_votes_count_insert AFTER INSERT ON poll_votes
+        BEGIN
+            UPDATE poll_options SET vote_count = vote_count + 1 WHERE id = NEW.option;
+        END
+    """,
+    "poll_votes_count_delete": """
+        CREATE TRIGGER poll_votes_count_delete AFTER DELETE ON poll_votes
+        BEGIN
+            UPDATE poll_options SET vote_count = vote_count - 1 WHERE id = OLD.option;
+        END
+    """,
+    "poll_votes_count_update": """
+        CREATE TRIGGER poll_votes_count_update AFTER UPDATE OF option ON poll_votes
+        BEGIN
+            UPDATE poll_options SET vote_count = vote_count - 1 WHERE id = OLD.option;
+            UPDATE poll_options SET vote_count = vote_count + 1 WHERE id = NEW.option;
+        END
+    """,
+    "question_votes_count_insert": """
+        CREATE TRIGGER question_votes_count_insert AFTER INSERT ON question_votes
+        BEGIN
+            UPDATE questions SET vote_count = vote_count + 1 WHERE id = NEW.question;
+        END
+    """,
+    "question_votes_count_delete": """
+        CREATE TRIGGER question_votes_count_delete AFTER DELETE ON question_votes
+        BEGIN
+            UPDATE questions SET vote_count = vote_count - 1 WHERE id = OLD.question;
+        END
+    """,
+    "question_votes_count_update": """
+        CREATE TRIGGER question_votes_count_update
+        AFTER UPDATE OF question ON question_votes
+        BEGIN
+            UPDATE questions SET vote_count = vote_count - 1 WHERE id = OLD.question;
+            UPDATE questions SET vote_count = vote_count + 1 WHERE id = NEW.question;
+        END
+    """,
+}
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("poll_options", schema=None) as batch_op:
+        batch_op.add_column(
+            sa.Column("vote_count", sa.Integer(), nullable=False, server_default="0")
+        )
+
+    with op.batch_alter_table("questions", schema=None) as batch_op:
+        batch_op.add_column(
+            sa.Column("vote_count", sa.Integer(), nullable=False, server_default="0")
+        )
+
+    op.execute(
+        "UPDATE poll_options SET vote_count = "
+        "(SELECT count(*) FROM poll_votes WHERE poll_votes.option = poll_options.id)"
+    )
+    op.execute(
+        "UPDATE questions SET vote_count = "
+        "(SELECT count(*) FROM question_votes "
+        "WHERE question_votes.question = questions.id)"
+    )
+
+    for trigger in TRIGGERS.values():
+        op.execute(trigger)
+
+
+def downgrade() -> None:
+    for name in TRIGGERS:
+        op.execute(f"DROP TRIGGER {name}")
+
+    with op.batch_alter_table("questions", schema=None) as batch_op:
+        batch_op.drop_column("vote_count")
+
+    with op.batch_alter_table("poll_options", schema=None) as batch_op:
+        batch_op.drop_column("vote_count")